@@ -1,8 +1,16 @@
+import asyncio
 import io
+import os
+import signal
+import subprocess
+import sys
+import tempfile
 import unittest
+import cxt
 from cxt import *
 from pprint import pprint as pp
 from collections import OrderedDict as odict
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 
 ACode = TAttrs(0); ACode.set_code()
 ABold = TAttrs(0); ABold.set_b()
@@ -33,6 +41,42 @@ class TestParser(unittest.TestCase):
     result = tx(p.until('[c]'))
     assert result == 'a b [c d] e'
 
+  def testUntilOverlap(self):
+    p = Parser('code [[c] after')
+    assert p.until('[c]') == 'code ['
+    assert p.buf[p.i:] == ' after'
+
+    p = Parser('a [## b [[###] c')
+    assert p.until('[###]') == 'a [## b ['
+    assert p.buf[p.i:] == ' c'
+
+    p = Parser('``x')
+    assert p.until('`') == ''
+    assert p.until('`') == ''
+    assert p.buf[p.i:] == 'x'
+
+    o = parse('[c]a [[c] b')
+    assert o == [text('a [', ACode), text(' b')]
+
+  def testUntilEof(self):
+    p = Parser('no end [c')
+    with self.assertRaises(zoa.ParseError): p.until('[c]')
+
+  def testSlots(self):
+    t = text('x')
+    c = Cont([t], CText, {})
+    for v in (t, t.tAttrs, c, c.cAttrs):
+      assert not hasattr(v, '__dict__')
+
+  def testShared(self):
+    o = parse('a [b]b[b] c [b]d[b] [t]e[/]')
+    assert o[1].tAttrs is o[3].tAttrs # interned
+    assert o[0].attrs is o[2].attrs
+
+  def testChngScoped(self):
+    o = parse('[t][b]x[/] y')
+    assert o == [Cont([text('x', ABold)], CText, {}), text(' y')]
+
   def testParseCmd(self):
     p = Parser('cmd   a   foo=bar]')
     cmd = p.parseCmd()
@@ -58,6 +102,15 @@ class TestParser(unittest.TestCase):
     assert p.i == len(p.buf)
     assert not p.s.out
 
+  def testParseLineRuns(self):
+    p = Parser('a  run\n   next [b]line[b]\r\n\n  done')
+    o = p.parse()
+    assert o == [
+      text('a  run next '),
+      text('line', ABold),
+      text('\r\ndone'),
+    ]
+
   def testInline(self):
     p = Parser('  text `some code ` more text\n')
     _, pg = p.parseLine(IN_PG)
@@ -138,6 +191,13 @@ class TestParser(unittest.TestCase):
     assert a[1] == li( [text('holla')], CNum, attrs={'value': text('2')} )
     assert a[2] == li( [text('hallo')], CNum, attrs={'value': text('3')} )
 
+  def testNumListLong(self):
+    o = parse('[+]\n  9. nine\n  10. ten\n  2023 was a year\n[/]')
+    assert len(o) == 1; a = o[0].arr; assert len(a) == 2
+    assert a[0] == li( [text('nine')], CNum, attrs={'value': text('9')} )
+    assert a[1] == li( [text('ten 2023 was a year')], CNum,
+                       attrs={'value': text('10')} )
+
   def testQuote(self):
     o = parse('''["]This is a quote[/]''')
     assert len(o) == 1;
@@ -246,6 +306,19 @@ class TestHtml(unittest.TestCase):
     )
     assert expected == result
 
+  def testSetGetShared(self):
+    o = parse('[t set=v][b]x[b][/]\n\n@v and @v [t][t set=w]w[/][/]@w.')
+    result = ''.join(html(o))
+    expected = (
+      '<span><b>x</b></span> and <span><b>x</b></span> '
+      '<span></span><span>w</span>.'
+    )
+    assert expected == result
+    assert o[1] is o[3] # not copied
+    assert o[1].html == '<span><b>x</b></span>' # rendered once
+    assert 'set' in o[0].attrs
+    assert expected == ''.join(html(o))
+
   def testGetAttr(self):
     o = parse(
         '[r set=url]http://google.com[/]\n'
@@ -265,6 +338,279 @@ class TestHtml(unittest.TestCase):
     expected = 'some text'
     assert expected == result
 
+  def testWrite(self):
+    b = '[t set=v]var[/]\n[h1]header[/]\nsome @v [b]text[b]\n[+]\n* item[/]'
+    f = io.StringIO()
+    htmlWrite(f, parse(b), sep='\n')
+    expected = ''.join(l + '\n' for l in html(parse(b)))
+    assert expected == f.getvalue()
+
+DOC = (
+  '[h1]Title[/]\n'
+  'Some [b]bold[b] text\n'
+  '[+]\n* one\n* two `code`\n[/]\n'
+  '[t set=v]var[/]\n'
+  '["]a quote @v[/]\n'
+  '[###]\ncode [#] block\n[###]\n'
+  'the end\n')
+
+class TestReparse(unittest.TestCase):
+  def edit(self, doc, offset, deleted, inserted):
+    full = parseDoc(doc.src[:offset] + inserted + doc.src[offset + deleted:])
+    assert reparse(doc, offset, deleted, inserted) is doc
+    assert full.src == doc.src
+    assert full.els == doc.els
+    assert full.marks() == doc.marks()
+    assert [full.span(i) for i in range(len(full.els))] == [
+      doc.span(i) for i in range(len(doc.els))]
+
+  def testReparse(self):
+    doc = parseDoc(DOC)
+    assert doc.els == parse(DOC)
+    first, last = doc.els[0], doc.els[-1]
+    i = DOC.index('two')
+    self.edit(doc, i, 3, 'three [i]')
+    assert doc.els[0] is first # before the edit
+    assert doc.els[-1] is last # after the edit
+    assert len(doc.tail) == 4  # the marks after the edit
+    self.edit(doc, i, 0, '[/]\n[+]\n') # split the list
+    assert len(doc.els) == len(parse(DOC)) + 1
+    self.edit(doc, 0, len('[h1]'), '[h2]')
+    assert len(doc.head) == 1 # the mark at 0, the others are after the edit
+    self.edit(doc, len(doc.src), 0, '\n[h3]more[/]')
+    self.edit(doc, doc.src.index('[###]'), 0, '[b]') # bold to the end
+    assert doc.els[-1].arr[0].tAttrs.is_b() # [h3]more[/]
+    self.edit(doc, 0, len(doc.src), '')
+    assert doc.els == []
+    self.edit(doc, 0, 0, DOC)
+    assert doc.els == parse(DOC)
+    self.edit(doc, 3, 0, '') # no-op
+
+  def testParagraphs(self):
+    # no block boundaries: the whole document is reparsed
+    doc = parseDoc('one\n\ntwo\nthree')
+    self.edit(doc, 4, 1, '')
+    assert doc.els == [text('one two three')]
+    with self.assertRaises(zoa.ParseError): reparse(doc, 3, 0, '[/]')
+    assert doc.src == 'one\ntwo\nthree' # unchanged
+
+  def testSpan(self):
+    doc = parseDoc(DOC)
+    assert doc.span(0) == (0, DOC.index('Some'))
+    # the text before the list is pending until [+]
+    i, j = DOC.index('Some'), DOC.index('[t set')
+    assert doc.span(1) == (i, j)
+    assert doc.span(4) == (i, j)
+    assert doc.span(5) == (j, DOC.index('["]'))
+    assert doc.span(len(doc.els) - 1)[1] == len(DOC)
+    reparse(doc, 0, 0, 'x') # the marks after it are in the tail
+    assert doc.span(0) == (0, i + 1) # x is a new element
+    assert doc.span(6) == (j + 1, DOC.index('["]') + 1)
+
+  def testHtml(self):
+    doc = parseDoc(DOC)
+    expected = html(parse(DOC))
+    assert expected == doc.html()
+    assert expected == doc.html() # not modified by the render
+    reparse(doc, DOC.index('var'), 3, 'VAR')
+    assert [h.replace('VAR', 'var') for h in doc.html()] == expected
+
+class TestBench(unittest.TestCase):
+  def testStages(self):
+    import bench
+    for name, corpus in bench.CORPORA.items():
+      doc = corpus(20_000)
+      for stage, (setup, fn) in bench.STAGES.items():
+        with self.subTest(corpus=name, stage=stage): fn(*setup(doc))
+
+class TestZoab(unittest.TestCase):
+  def testRoundTrip(self):
+    b = """[h1]Title[/]
+[t set=name]Some [b]name[b][/]
+Text with @name, `code` and [t r=@ref x=1 y=a@b]attrs[/].
+[t set=ref]http://example.com[/]
+[+]
+* [b]one[b]
+* two
+[ ] unchecked
+[/]
+[+]
+  1. numbered
+  2. second
+[/]
+[!]hidden[/]
+"""
+    els = parse(b)
+    got = loadZoab(dumpZoab(els))
+    assert got == els
+    link = next(el for el in got if 'r' in el.attrs)
+    assert link.attrs['r'].tAttrs.is_get()
+    assert html(got) == html(parse(b))
+
+    els = parse('[t flag x=1]x[/]\n') # attr without a value
+    assert loadZoab(dumpZoab(els)) == els
+    assert els[0].attrs['flag'] is None
+
+  def testRoundTripAttrs(self):
+    for b in ['[r][/]', '[r]@foo[/]', '[t a= @x b=\\y]x[/]',
+              '[t set=v]v[/]\n[t a=@v]x[/]\n']:
+      els = parse(b)
+      got = loadZoab(dumpZoab(els))
+      assert got == els, b
+      assert html(got) == html(parse(b)), b
+    assert els[1].attrs['a'].tAttrs.is_get()
+
+  def testTyped(self):
+    # loadZoab decodes the same as the El type, including joined blocks
+    import bench
+    b = ('[t set=v]' + 'long ' * 50 + '[/]\n'
+         + '[+]\n' + '* item\n' * 70 + '[/]\n' + bench.corpusAttrs(0, width=40))
+    for els in [parse(b)] + [parse(c(2_000)) for c in bench.CORPORA.values()]:
+      z = dumpZoab(els)
+      typed = [cxtEl(el) for el in ArrEl.frZ(zoa.decode_zoab(z)[0])]
+      assert loadZoab(z) == typed == els
+      assert loadZoab(memoryview(z)) == els
+    z = dumpZoab(parse('[t a=1 b=@v]x[/] [b]' + 'y' * 70 + '[b]\n'))
+    for end in range(len(z)):
+      with self.assertRaises(zoa.Eof): loadZoab(z[:end])
+    z = dumpZoab([text('x')])
+    with self.assertRaises(ValueError): loadZoab(z.replace(b'\x00', b'\x02', 1))
+
+  def testExport(self):
+    with tempfile.TemporaryDirectory() as d:
+      src = os.path.join(d, 'a.cxt')
+      with open(src, 'w') as f: f.write('[t set=v]var[/]\n[b]a[b] @v.\n')
+      export(src, os.path.join(d, 'a.zoab'))
+      export(os.path.join(d, 'a.zoab'), os.path.join(d, 'a.html'))
+      export(src, os.path.join(d, 'b.html'))
+      with open(os.path.join(d, 'a.html')) as f: a = f.read()
+      with open(os.path.join(d, 'b.html')) as f: b = f.read()
+      assert a.replace('a.zoab', 'a.cxt') == b
+
+class TestCli(unittest.TestCase):
+  def writeTree(self, root):
+    os.makedirs(os.path.join(root, 'sub', 'deep'))
+    for p, b in [('a.cxt', '[b]a[b]'), ('sub/b.cxt', '[h1]b[/]'),
+                 ('sub/deep/c.cxt', 'c'), ('sub/ignored.txt', 'x')]:
+      with open(os.path.join(root, p), 'w') as f: f.write(b)
+
+  def testExportPaths(self):
+    with tempfile.TemporaryDirectory() as d:
+      src = os.path.join(d, 'src'); self.writeTree(src)
+      out = os.path.join(d, 'out')
+      result = exportPaths(src, out, '.md')
+      assert result == [
+        (os.path.join(src, 'a.cxt'), os.path.join(out, 'a.md')),
+        (os.path.join(src, 'sub/b.cxt'), os.path.join(out, 'sub/b.md')),
+        (os.path.join(src, 'sub/deep/c.cxt'),
+         os.path.join(out, 'sub/deep/c.md')),
+      ]
+
+  def testExportDir(self):
+    for jobs in (1, 2):
+      with tempfile.TemporaryDirectory() as d:
+        src = os.path.join(d, 'src'); self.writeTree(src)
+        out = os.path.join(d, 'out')
+        result = exportDir(src, out, '.html', jobs=jobs)
+        assert len(result) == 3
+        assert all(err is None for _p, _e, _t, err in result)
+        with open(os.path.join(out, 'sub/b.html')) as f:
+          assert '<h1>b</h1>' in f.read()
+        assert os.path.exists(os.path.join(out, 'sub/deep/c.html'))
+
+  def testExportDirCache(self):
+    def built(result): return sorted(p for p, _e, t, _err in result if t is not None)
+    with tempfile.TemporaryDirectory() as d:
+      src = os.path.join(d, 'src'); self.writeTree(src)
+      out = os.path.join(d, 'out')
+      a, b, c = [os.path.join(src, p) for p in
+                 ('a.cxt', 'sub/b.cxt', 'sub/deep/c.cxt')]
+      assert built(exportDir(src, out, jobs=1)) == [a, b, c]
+      assert built(exportDir(src, out, jobs=1)) == []
+
+      with open(b, 'w') as f: f.write('[h2]changed[/]')
+      os.remove(os.path.join(out, 'sub/deep/c.html'))
+      assert built(exportDir(src, out, jobs=1)) == [b, c]
+      with open(os.path.join(out, 'sub/b.html')) as f:
+        assert '<h2>changed</h2>' in f.read()
+
+      assert built(exportDir(src, out, jobs=1, force=True)) == [a, b, c]
+
+class TestServer(unittest.TestCase):
+  async def requests(self, addr, reqs):
+    """Send the raw requests on one connection, returning [(status, body)]."""
+    reader, writer = await asyncio.open_unix_connection(addr)
+    out = []
+    for req in reqs:
+      writer.write(req); await writer.drain()
+      head = (await reader.readuntil(b'\r\n\r\n')).decode().split('\r\n')
+      length = next(int(l.split(':')[1]) for l in head if l.startswith('Content-Length'))
+      out.append((int(head[0].split()[1]), (await reader.readexactly(length)).decode()))
+    writer.close()
+    return out
+
+  def post(self, body: str, target='/html'):
+    b = body.encode('utf-8')
+    return b'POST %s HTTP/1.1\r\nContent-Length: %d\r\n\r\n' % (target.encode(), len(b)) + b
+
+  def testServe(self):
+    async def run(addr, pool):
+      server = await startServer(addr, pool)
+      async with server:
+        got = await self.requests(addr, [
+          self.post('hi [b]there[b]'), self.post('[b'), self.post('x', '/nope'),
+          b'GET /html HTTP/1.1\r\n\r\n', self.post('[t set=a]A[/]@a and @a\n')])
+        assert got[0] == (200, 'hi \n<b>there</b>')
+        assert got[1][0] == 400 and got[1][1].startswith('ParseError')
+        assert [s for s, _b in got[2:4]] == [404, 405]
+        assert got[4] == (200, '\n<span>A</span>\n and \n<span>A</span>')
+        got = await self.requests(addr, [b'POST /html HTTP/1.1\r\n\r\n'])
+        assert got == [(411, 'Content-Length is required\n')]
+
+    with tempfile.TemporaryDirectory() as d, ThreadPoolExecutor(2) as pool:
+      asyncio.run(run(os.path.join(d, 'a.sock'), None))
+      asyncio.run(run(os.path.join(d, 'b.sock'), pool))
+
+  def testBrokenPool(self):
+    async def run(addr, pool, newPool):
+      server = await startServer(addr, pool, newPool)
+      async with server:
+        assert await self.requests(addr, [self.post('a')]) == [(200, 'a')]
+        for pid in pool._processes: os.kill(pid, signal.SIGKILL)
+        got = await self.requests(addr, [self.post('a'), self.post('b')])
+        assert got == [(500, 'The render worker died\n'), (200, 'b')]
+
+    pools = [ProcessPoolExecutor(1)]
+    def newPool(): pools.append(ProcessPoolExecutor(1)); return pools[-1]
+    try:
+      with tempfile.TemporaryDirectory() as d:
+        asyncio.run(run(os.path.join(d, 'a.sock'), pools[0], newPool))
+    finally:
+      for p in pools: p.shutdown()
+    assert len(pools) == 2
+
+  def testTruncated(self):
+    class Writer:
+      def write(self, b): self.out = b
+      async def drain(self): pass
+      def close(self): pass
+    async def run():
+      reader = asyncio.StreamReader()
+      reader.feed_data(self.post('[b]bold[b]')[:-3]); reader.feed_eof()
+      await cxt._serveConn(lambda src: None, reader, Writer())
+    asyncio.run(run())
+
+  def testSigterm(self):
+    with tempfile.TemporaryDirectory() as d:
+      p = subprocess.Popen(
+        [sys.executable, cxt.__file__, '--serve', os.path.join(d, 'a.sock'), '-j', '2'],
+        stdout=subprocess.PIPE, text=True)
+      assert p.stdout.readline().startswith('Serving')
+      p.terminate()
+      # the workers inherit stdout, so it is only closed once they exited
+      out, _err = p.communicate(timeout=30)
+      assert p.returncode == 0 and out == ''
+
 if __name__ == '__main__':
   unittest.main()
 
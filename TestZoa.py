@@ -0,0 +1,499 @@
+import copy
+import dataclasses
+import io
+import marshal
+import os
+import tempfile
+import unittest
+import unittest.mock
+from collections import OrderedDict as odict
+from zoa import *
+
+def writeRaw(z: ZoaRaw) -> bytes:
+  """Serialize with the streaming writers."""
+  bw = io.BytesIO()
+  if z.data is not None: write_data(bw, z.data)
+  else:                  write_arr(bw, z.arr)
+  return bw.getvalue()
+
+LENGTHS = (0, 1, 62, 63, 64, 125, 126, 127, 63 * 64, 63 * 64 + 1, 10_000)
+
+class TestEncode(unittest.TestCase):
+  def testData(self):
+    for length in LENGTHS:
+      data = bytes(i % 251 for i in range(length))
+      z = ZoaRaw.new_data(data)
+      expected = writeRaw(z)
+      assert z.encode() == expected, length
+      assert from_zoab(io.BytesIO(expected)).data == data
+
+  def testArr(self):
+    for length in LENGTHS[:-1]:
+      z = ZoaRaw.frPy([b'%d' % i for i in range(length)])
+      expected = writeRaw(z)
+      assert z.encode() == expected, length
+      assert from_zoab(io.BytesIO(expected)) == z
+
+  def testNested(self):
+    z = ZoaRaw.frPy([b'', [b'a' * 100, [], [[b'b']]], [b'c'] * 70, b'd' * 5000])
+    expected = writeRaw(z)
+    assert z.encode() == expected
+    assert z.serialize().getvalue() == expected
+    bw = io.BytesIO(); z.serialize(bw)
+    assert bw.read() == expected
+    assert from_zoab(z.serialize()) == z
+
+class TestDecode(unittest.TestCase):
+  def assertDecodes(self, z: ZoaRaw):
+    b = z.encode() + b'after'
+    got, end = decode_zoab(b)
+    assert got == z
+    assert b[end:] == b'after'
+    return got
+
+  def testData(self):
+    for length in LENGTHS:
+      data = bytes(i % 251 for i in range(length))
+      self.assertDecodes(ZoaRaw.new_data(data))
+
+  def testDecodeData(self):
+    for length in LENGTHS + (300 * 63,):
+      data = bytes(i % 251 for i in range(length))
+      b = bytes(ZoaRaw.new_data(data).encode()) + b'after'
+      got, end = decode_data(b, 0)
+      assert got == data and b[end:] == b'after'
+      assert type(got) is (bytes if length <= 63 else bytearray)
+      with self.assertRaises(Eof): decode_data(b[:end - 1])
+    # join blocks which aren't full
+    b = bytes([ZOA_JOIN | 63]) + b'a' * 63 + bytes([ZOA_JOIN | 2]) + b'bc' \
+      + bytes([ZOA_JOIN | 63]) + b'd' * 63 + bytes([1]) + b'e'
+    assert decode_data(b) == (b'a' * 63 + b'bc' + b'd' * 63 + b'e', len(b))
+    assert decode_data(memoryview(b)) == decode_data(b)
+    with self.assertRaises(ValueError): decode_data(bytes([ZOA_ARR]))
+    with self.assertRaises(ValueError): decode_data(bytes([ZOA_JOIN | 1, 0, ZOA_ARR]))
+
+  def testView(self):
+    b = ZoaRaw.frPy([b'abc', b'd' * 100]).encode()
+    got, _ = decode_zoab(memoryview(b))
+    assert isinstance(got.arr[0].data, memoryview) # not copied
+    assert isinstance(got.arr[1].data, bytearray)  # joined
+    assert got.to_py() == [b'abc', b'd' * 100]
+
+  def testArr(self):
+    for length in LENGTHS[:-1]:
+      self.assertDecodes(ZoaRaw.frPy([b'%d' % i for i in range(length)]))
+    self.assertDecodes(
+      ZoaRaw.frPy([b'', [b'a' * 100, [], [[b'b']]], [b'c'] * 70, b'd' * 5000]))
+
+  def testDeep(self):
+    depth = 10_000 # arr[x, arr[x, ... arr[]]]
+    b = bytes([ZOA_ARR | 2, 1, ord('x')]) * depth + bytes([ZOA_ARR])
+    got, end = decode_zoab(b)
+    assert end == len(b)
+    for _ in range(depth):
+      assert len(got.arr) == 2 and got.arr[0].data == b'x'
+      got = got.arr[1]
+    assert got.arr == []
+
+  def testEof(self):
+    b = ZoaRaw.frPy([b'abc', [b'd' * 100]]).encode()
+    for end in range(len(b)):
+      with self.assertRaises(Eof): decode_zoab(b[:end])
+
+  def testMmap(self):
+    z = ZoaRaw.frPy([b'abc', [b'd' * 100, b'']])
+    with tempfile.TemporaryDirectory() as d:
+      path = os.path.join(d, 'test.zoab')
+      with open(path, 'wb') as f: f.write(z.encode())
+      got = mmap_zoab(path)
+      assert got == z
+      assert got.to_py() == [b'abc', [b'd' * 100, b'']]
+      assert Str.frZ(got.arr[0]) == 'abc'
+
+class Unseekable:
+  """A reader which can only read, like a socket or pipe."""
+  def __init__(self, b: bytes): self.br = io.BytesIO(b)
+  def read(self, n): return self.br.read(n)
+
+STREAM = [[b'a', [b'b' * 100, []]], b'c' * 200, [], [b'd'] * 70]
+
+def streamBytes(values) -> bytes:
+  return b''.join(bytes(ZoaRaw.frPy(v).encode()) for v in values)
+
+class TestReader(unittest.TestCase):
+  def testIter(self):
+    b = streamBytes(STREAM)
+    for br in (io.BytesIO(b), Unseekable(b)):
+      assert [z.to_py() for z in ZoabReader(br)] == STREAM
+
+  def testEvents(self):
+    D, S, E = ZoaEvent.DATA, ZoaEvent.ARR_START, ZoaEvent.ARR_END
+    r = ZoabReader(io.BytesIO(streamBytes([[b'a', [b'b']], b'c'])))
+    assert list(r.events()) == [
+      (S, None), (D, b'a'), (S, None), (D, b'b'), (E, None), (E, None),
+      (D, b'c')]
+
+  def testReadInArr(self):
+    r = ZoabReader(io.BytesIO(streamBytes(STREAM)))
+    assert next(r.events()) == (ZoaEvent.ARR_START, None)
+    assert r.read().to_py() == b'a'
+    assert r.read().to_py() == [b'b' * 100, []]
+    assert r.read() is None # end of the array
+    assert r.read().to_py() == b'c' * 200
+
+  def testSkip(self):
+    b = streamBytes(STREAM)
+    for br in (io.BytesIO(b), Unseekable(b)):
+      r = ZoabReader(br)
+      events = r.events()
+      assert next(events) == (ZoaEvent.ARR_START, None)
+      assert next(events) == (ZoaEvent.DATA, b'a')
+      assert next(events) == (ZoaEvent.ARR_START, None)
+      r.skip() # [b'b' * 100, []]
+      assert next(events) == (ZoaEvent.ARR_END, None)
+      assert r.skip() # b'c' * 200
+      assert r.skip() # []
+      assert r.read().to_py() == [b'd'] * 70
+      assert not r.skip()
+      assert r.read() is None
+
+  def testEof(self):
+    b = streamBytes(STREAM)
+    ends = [len(streamBytes(STREAM[:i])) for i in range(len(STREAM))]
+    for end in range(len(b)):
+      r = ZoabReader(io.BytesIO(b[:end]))
+      if end in ends: # cut between top-level values
+        assert len(list(r)) == ends.index(end)
+      else:
+        with self.assertRaises(Eof): list(r)
+
+class TestIndex(unittest.TestCase):
+  def testSkip(self):
+    for v in STREAM + [b'', [[]], [[b'x'] * 200] * 3]:
+      b = ZoaRaw.frPy(v).encode() + b'after'
+      assert skip_zoab(b) == len(b) - len(b'after'), v
+    with self.assertRaises(Eof): skip_zoab(ZoaRaw.frPy([b'x' * 100]).encode()[:-1])
+
+  def testFile(self):
+    items = [[b'a', [b'b' * 100]], b'c' * 200, [], [b'%d' % i for i in range(70)]]
+    items += [[b'e%d' % i] for i in range(100)]
+    z = ZoaRaw.frPy(items)
+    with tempfile.TemporaryDirectory() as d:
+      path = os.path.join(d, 'test.zoab')
+      with open(path, 'wb') as f: f.write(z.encode())
+      for depth in (1, 2):
+        assert write_zoab_index(path, depth) == path + '.zidx'
+        with ZoabFile(path) as zf:
+          assert len(zf) == len(items)
+          for i, item in enumerate(items): assert zf[i].to_py() == item
+          assert zf[-1].to_py() == items[-1]
+          with self.assertRaises(IndexError): zf[len(items)]
+          if depth == 1:
+            with self.assertRaises(ValueError): zf.item(0, 0)
+            continue
+          assert zf.item(0, 1).to_py() == [b'b' * 100]
+          assert zf.item(3, 69).to_py() == b'69'
+          with self.assertRaises(IndexError): zf.item(1, 0) # data has no items
+          with self.assertRaises(IndexError): zf.item(2, 0)
+
+      def rewrite(b):
+        st = os.stat(path)
+        with open(path, 'wb') as f: f.write(b)
+        os.utime(path, ns=(st.st_atime_ns, st.st_mtime_ns)) # keep the mtime
+      b = z.encode()
+      rewrite(b.replace(b'e99', b'e00')) # same size and mtime
+      with self.assertRaises(ValueError): ZoabFile(path) # stale
+      rewrite(b)
+      with ZoabFile(path) as zf: assert zf[-1].to_py() == items[-1]
+      os.utime(path, ns=(0, 0)) # a new mtime
+      with self.assertRaises(ValueError): ZoabFile(path)
+
+      with open(path, 'ab') as f: f.write(b'more')
+      with self.assertRaises(ValueError): ZoabFile(path) # stale
+
+def newPoint(env: TyEnv):
+  return env.struct(b'', b'Point', odict([
+    (b'x',     StructField(Int)),
+    (b'y',     StructField(Int)),
+    (b'label', StructField(Str, zid=1)),
+    (b'tags',  StructField(ArrStr, zid=7)),
+  ]))
+
+class TestStruct(unittest.TestCase):
+  def newPoint(self, slots=False): return newPoint(TyEnv(slots=slots))
+
+  def testZid(self):
+    for slots in (False, True):
+      Point = self.newPoint(slots)
+      p = Point(Int(1), Int(2), label=Str('a'), tags=ArrStr([Str('t')]))
+      z = p.toZ()
+      assert z.to_py() == [b'\x02', b'\x01', b'\x02',
+                           [b'\x01', b'a'], [b'\x07', [b't']]]
+      assert Point.frZ(z) == p
+      assert Point.frZ(decode_zoab(z.encode())[0]) == p
+
+      p = Point(Int(1), Int(2)) # fields with a zid are optional
+      assert p.label is None and p.toZ().to_py() == [b'\x02', b'\x01', b'\x02']
+      assert Point.frZ(p.toZ()) == p
+      p = Point(Int(3), None, tags=ArrStr())
+      assert Point.frZ(p.toZ()) == p
+
+  def testInvalid(self):
+    Point = self.newPoint()
+    with self.assertRaises(ValueError): # y is set but x isn't
+      Point(None, Int(2)).toZ()
+    with self.assertRaises(ValueError): # too many positional
+      Point.frZ(ZoaRaw.frPy([b'\x03', b'\x01', b'\x02', b'\x03']))
+    with self.assertRaises(ValueError):
+      TyEnv().struct(b'', b'Bad', odict([
+        (b'a', StructField(Int, zid=1)), (b'b', StructField(Int))]))
+
+class TestParser(unittest.TestCase):
+  def testTokens(self):
+    p = Parser(b' struct A_1 [\n  x.y: Map[Str,Int];\t\\ c\n] 0x1F +=+ $(|)%')
+    tokens = []
+    while (t := p.token()): tokens.append(bytes(t))
+    assert tokens == [
+      b'struct', b'A_1', b'[', b'x.y', b':', b'Map', b'[', b'Str', b',', b'Int',
+      b']', b';', b']', b'0x1F', b'+=+', b'$', b'(', b'|', b')', b'%']
+    assert p.line == 3 and (p.skippedLines, p.skippedSpaces) == (2, 10)
+    assert all(TG_TABLE[c] is coaleseTG(TG.fromChr(c)) for c in range(256))
+
+  def testDeclare(self):
+    p = Parser(b"""
+      declare A; declare B; declare E;
+      struct A [ b: B; bs: Arr[B]; e: E ]
+      enum E [ a: A; m: Map[Str,B] ]
+      struct B [ a: Arr[A]; b: B ]
+    """); p.parse()
+    assert p.env.referrers == {}
+    for ty in p.env.tys.values():
+      assert not any(isinstance(c, Undefined) for c in tyChildren(ty) or ()), ty
+    A, B = p.env.tys[b'A'], p.env.tys[b'B']
+    assert A._fields[b'b'].ty is B and B._fields[b'b'].ty is B
+
+class TestEnum(unittest.TestCase):
+  def testFalsy(self):
+    for compiled in (False, True):
+      p = Parser(b'enum E [ i: Int; s: Str; a: Arr[Int] ]'); p.parse()
+      if compiled: p.env.compile()
+      E = p.env.tys[b'E']
+      for e in [E(i=Int(0)), E(s=Str('')), E(a=ArrInt()), E(i=Int(3))]:
+        assert E.frZ(e.toZ()) == e, (compiled, e)
+      assert E(s=Str('')).toZ().to_py() == [b'\x01', b'']
+
+      e = E(); e.s = Str('x') # set after construction
+      assert E.frZ(e.toZ()) == e
+      e.s, e.i = None, Int(0)  # changed
+      assert e.toZ().to_py() == [b'\x00', b'\x00']
+      with self.assertRaises(ValueError): E(i=Int(0), s=Str(''))
+      with self.assertRaises(ValueError): E().toZ()
+
+BITMAP = b"""
+bitmap Attrs [
+  get   0x01  0x0F
+  code  0x10
+  i     0x20
+  b     0x40
+]
+"""
+
+class TestBitmap(unittest.TestCase):
+  def newTy(self):
+    p = Parser(BITMAP); p.parse()
+    return p.env.tys[b'Attrs']
+
+  def testInterned(self):
+    Attrs = self.newTy()
+    b = Attrs.intern(0x40)
+    assert b is Attrs.intern(0x40) and b == Attrs(0x40)
+    with self.assertRaises(TypeError): b.tog_b()
+    with self.assertRaises(TypeError): b.set_i()
+    with self.assertRaises(TypeError): b.value = 0
+    with self.assertRaises(TypeError): b.value |= 0x10
+    assert b.value == 0x40
+    a = Attrs(0x40); a.value = 0; a.set_b() # not interned
+    assert a == b and b == a and a != Attrs.intern(0) and a != self.newTy()(0x40)
+    assert isinstance(b, Attrs) and repr(b) == repr(a) == 'Attrs(value=64)'
+    assert copy.copy(b) is b and copy.deepcopy(b) is b
+    assert copy.deepcopy(a) == a and copy.deepcopy(a) is not a
+
+    assert BitmapBase(3).value == 3 and BitmapBase.intern(3) == BitmapBase(3)
+    class Sub(BitmapBase): pass
+    s = Sub(1); s.value = 2
+    assert Sub.intern(2) == s and Sub.intern(2) is not BitmapBase.intern(2)
+    with self.assertRaises(TypeError): Sub.intern(2).value = 1
+
+  def testCol(self):
+    Attrs = self.newTy()
+    Col = Attrs.Col
+    code, bold = Attrs(0x10), Attrs(0x40)
+    bms = [Attrs(v) for v in (0, bold.value, bold.value | code.value, code.value)]
+    col = Col.frBitmaps(bms)
+    assert len(col) == 4 and col.values.typecode == 'I'
+    assert col.toBitmaps() == bms and list(col) == bms and col[1] == bold
+    assert col.toBitmaps(intern=True)[1] is Attrs.intern(bold.value)
+    assert col.is_b() == [b.is_b() for b in bms]
+    assert col.get_code().tolist() == [b.get_code() for b in bms]
+
+    col.set_i(mask=col.is_code()) # only code
+    assert col.is_i() == [False, False, True, True]
+    col.set_b()
+    assert all(col.is_b())
+    for b in bms: b.set_b()
+    assert col.get_code().tolist() == [b.get_code() for b in bms]
+    with self.assertRaises(ValueError): col.set_b(mask=[True])
+    with self.assertRaises(ValueError): col.set_b(var=0x100000)
+
+TREE = b"""
+declare Tree;
+struct Leaf [ a: Int; b: Str; m: Map[Str,Int] ]
+struct Node [ leaf: Leaf; kids: Arr[Tree]; d: Dyn ]
+enum Tree [ leaf: Leaf; node: Node ]
+"""
+
+def newTree(tys, depth):
+  Leaf, Node, Tree = tys[b'Leaf'], tys[b'Node'], tys[b'Tree']
+  MapStrInt, ArrTree = Leaf._fields[b'm'].ty, Node._fields[b'kids'].ty
+  leaf = Leaf(Int(1), Str('b'), MapStrInt({Str('k'): Int(2)}))
+  t = Tree(leaf=leaf)
+  for i in range(depth):
+    t = Tree(node=Node(leaf, ArrTree([t, Tree(leaf=leaf)]), Dyn.frPy(i)))
+  return t
+
+class TestCompile(unittest.TestCase):
+  def newEnv(self, compiled):
+    p = Parser(TREE); p.parse()
+    if compiled: p.env.compile()
+    return p.env.tys
+
+  def testRoundTrip(self):
+    generic, compiled = self.newEnv(False), self.newEnv(True)
+    assert compiled[b'Leaf']._frZ is None    # flat: direct
+    assert compiled[b'Tree']._frZ is not None # recursive
+    for depth in (0, 1, 3, 10_000):
+      b = newTree(compiled, depth).toZ().encode() # compare bytes: no recursion
+      assert b == newTree(generic, depth).toZ().encode()
+      got = compiled[b'Tree'].frZ(decode_zoab(b)[0])
+      assert got.toZ().encode() == b
+      if depth < 10: assert got == newTree(compiled, depth)
+
+  def testFallback(self):
+    env = TyEnv(); Point = newPoint(env); env.compile()
+    assert Point.toZ is not StructBase.toZ
+    for p in [Point(Int(1), Int(2)), Point(Int(1), None),
+              Point(Int(1), Int(2), label=Str('a')), Point(None, None)]:
+      assert Point.frZ(p.toZ()) == p
+    with self.assertRaises(ValueError): Point(None, Int(2)).toZ()
+
+class TestSchemaCache(unittest.TestCase):
+  def assertSameTypes(self, a: TyEnv, b: TyEnv):
+    assert set(a.tys) == set(b.tys)
+    for name, ty in a.tys.items():
+      other = b.tys[name]
+      if name in a.builtins: assert ty is other; continue
+      assert ty.__name__ == other.__name__ and ty.__bases__ == other.__bases__
+      if issubclass(ty, StructBase):
+        assert [(n, tyExpr(f.ty, set()), f.zid) for n, f in ty._fields.items()] \
+            == [(n, tyExpr(f.ty, set()), f.zid) for n, f in other._fields.items()]
+        assert ty.__slots__ == other.__slots__
+      if issubclass(ty, (StructBase, EnumBase)):
+        fields = lambda t: [(f.name, f.default, type(f.type))
+                            for f in dataclasses.fields(t)]
+        assert fields(ty) and fields(ty) == fields(other)
+        assert repr(ty.__dataclass_params__) == repr(other.__dataclass_params__)
+
+  def testLoad(self):
+    with tempfile.TemporaryDirectory() as d:
+      parsed = schemaEnv(TREE, slots=True)
+      env = loadSchema(TREE, d, slots=True)
+      assert len(os.listdir(d)) == 1
+      self.assertSameTypes(parsed, env)
+      cached = loadSchema(TREE, d, slots=True)
+      self.assertSameTypes(parsed, cached)
+      assert cached.tys[b'Tree'] is not env.tys[b'Tree'] # not shared
+      tree = newTree(cached.tys, 3)
+      assert tree == newTree(cached.tys, 3)
+      assert repr(tree) == repr(newTree(parsed.tys, 3))
+      b = tree.toZ().encode()
+      assert b == newTree(parsed.tys, 3).toZ().encode()
+      assert cached.tys[b'Tree'].frZ(decode_zoab(b)[0]) == tree
+      assert repr(dataclasses.asdict(tree)) \
+          == repr(dataclasses.asdict(newTree(parsed.tys, 3)))
+      assert dataclasses.replace(tree, leaf=None) == tree
+      assert dataclasses.replace(tree.node, d=None).d is None
+
+      loadSchema(TREE, d, slots=False) # keyed on slots
+      assert len(os.listdir(d)) == 2
+      loadSchema(TREE, d, slots=False, write=False)
+      files = sorted(os.listdir(d))
+      def stamps():
+        out = []
+        for name in sorted(os.listdir(d)):
+          with open(os.path.join(d, name), 'rb') as f: out.append(marshal.load(f)[0])
+        return out
+      with unittest.mock.patch('zoa._sourceStamp', lambda: b'zoa.py changed'):
+        loadSchema(TREE, d, slots=True, write=False)
+        assert len(os.listdir(d)) == 2
+        self.assertSameTypes(parsed, loadSchema(TREE, d, slots=True))
+        assert sorted(os.listdir(d)) == files # overwritten: no orphans
+        assert b'zoa.py changed' in stamps()
+        self.assertSameTypes(parsed, loadSchema(TREE, d, slots=True))
+      self.assertSameTypes(parsed, loadSchema(TREE, d, slots=True))
+      assert b'zoa.py changed' not in stamps() and sorted(os.listdir(d)) == files
+
+  def testCorrupt(self):
+    with tempfile.TemporaryDirectory() as d:
+      parsed = schemaEnv(TREE)
+      loadSchema(TREE, d); [name] = os.listdir(d)
+      path = os.path.join(d, name)
+      with open(path, 'rb') as f: good = f.read()
+      for data in (b'', b'garbage', good[:-10], marshal.dumps(b'code')):
+        with open(path, 'wb') as f: f.write(data)
+        self.assertSameTypes(parsed, loadSchema(TREE, d))
+        assert os.listdir(d) == [name]
+
+  def testZid(self):
+    env = TyEnv(); newPoint(env)
+    ns = {}; exec(pySource(env), ns)
+    Point = ns['env'].tys[b'Point']
+    p = Point(Int(1), Int(2), label=Str('a'))
+    assert p.tags is None and repr(p) == repr(env.tys[b'Point'](Int(1), Int(2), Str('a')))
+    assert Point.frZ(p.toZ()) == p
+
+class TestDeep(unittest.TestCase):
+  """Values nested too deep for recursion."""
+  depth = 100_000
+
+  def assertDeep(self, py):
+    for _ in range(self.depth): # py = [b'x', [b'x', ... []]]
+      assert len(py) == 2 and py[0] == b'x'
+      py = py[1]
+    assert py == []
+
+  def testRaw(self):
+    py = []
+    for _ in range(self.depth): py = [b'x', py]
+    z = ZoaRaw.frPy(py)
+    self.assertDeep(z.to_py())
+
+    b = z.encode()
+    assert writeRaw(z) == b
+    assert z.serialize().getvalue() == b
+    self.assertDeep(from_zoab(io.BytesIO(b)).to_py())
+    got, end = decode_zoab(b)
+    assert end == len(b)
+    self.assertDeep(got.to_py())
+
+  def testTypes(self):
+    v = Dyn.frPy('leaf')
+    for _ in range(self.depth): v = Dyn.frPyArrDyn([v])
+    z = v.toZ()
+    got = Dyn.frZ(decode_zoab(z.encode())[0])
+    for _ in range(self.depth):
+      assert got.ty is DynType.ArrDyn and len(got.value) == 1
+      got = got.value[0]
+    assert got.ty is DynType.Str and got.value == 'leaf'
+
+if __name__ == '__main__':
+  unittest.main()
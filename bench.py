@@ -0,0 +1,376 @@
+"""Benchmarks for cxt.py and zoa.py
+
+Every corpus (a generated document) is run through each stage of an export
+and the best time, throughput and peak memory of every stage is reported.
+
+Run with: python3 bench.py [--size CHARS] [--json OUT] [--compare PREV]
+Or time zoa types instead: python3 bench.py --records N | --schema STRUCTS
+Or time loading the cxt types and importing cxt: python3 bench.py --import
+
+The corpora are deterministic, so results saved with --json on one commit can
+be compared against another with --compare.
+"""
+
+import argparse
+import io
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from importlib.util import cache_from_source
+from typing import Tuple
+
+import cxt
+import zoa
+
+####################
+# Corpora
+
+PARAGRAPH = (
+  "Some plain text with `inline code` and [b]bold[b] and [i]italic[i]\n"
+  "words, wrapped over a couple of lines like a normal document would\n"
+  "be written. Here is a [t r=http://example.com]link[/] and more text.\n"
+  "\n"
+)
+
+def repeatTo(size: int, unit: str) -> str:
+  return unit * max(1, size // len(unit))
+
+def corpusText(size: int) -> str:
+  """Plain paragraphs with a sprinkling of inline markup."""
+  return repeatTo(size, PARAGRAPH)
+
+def corpusNested(size: int, depth=64) -> str:
+  """Blocks nested depth levels deep."""
+  opens = ''.join('["]' if d % 2 else '[t]' for d in range(depth))
+  unit = f'{opens}deep [b]text[b]{"[/]" * depth}\n\n'
+  return repeatTo(size, unit)
+
+def corpusCodeBlock(size: int) -> str:
+  """A single huge [###] code block, i.e. generated config."""
+  line = "key_%d = [value] # [##] not the end [#]\n"
+  lines = []; length = 0
+  while length < size:
+    lines.append(line % len(lines)); length += len(lines[-1])
+  return 'config:\n[###]\n' + ''.join(lines) + '[###]\n'
+
+def corpusList(size: int, items=1000) -> str:
+  """Long lists of bullets, numbers and checkboxes."""
+  lists = []
+  for kind in ('* ', '1. ', '[ ] ', '[X] '):
+    if kind == '1. ':
+      lines = [f'  {n}. item {n} [b]bold[b]\n' for n in range(items)]
+    else: lines = [f'  {kind}item {n} `code`\n' for n in range(items)]
+    lists.append('[+]\n' + ''.join(lines) + '[/]\n\n')
+  return repeatTo(size, ''.join(lists))
+
+def corpusVars(size: int) -> str:
+  """A shared footer (link table) set once and referenced many times."""
+  links = ''.join(f'  * [t r=http://example.com/{i}]link {i}[/]\n'
+                  for i in range(50))
+  footer = f'[t set=footer][+]\n{links}[/][/]\n\n'
+  return footer + repeatTo(size, 'Some text and the footer: @footer\n\n')
+
+def corpusAttrs(size: int, width=32) -> str:
+  """Blocks with many attributes each."""
+  attrs = ' '.join(f'attr{a}=value{a}' for a in range(width))
+  return repeatTo(size, f'[t {attrs} r=http://example.com]text[/]\n')
+
+CORPORA = {
+  'text':   corpusText,
+  'nested': corpusNested,
+  'code':   corpusCodeBlock,
+  'list':   corpusList,
+  'vars':   corpusVars,
+  'attrs':  corpusAttrs,
+}
+
+####################
+# Stages
+#
+# Each stage is (setup, fn). setup(doc) returns the arguments for fn and is
+# not measured.
+
+def countNodes(els) -> int:
+  n = 0
+  for el in els:
+    n += 1
+    if isinstance(el, cxt.Cont): n += countNodes(el.arr)
+  return n
+
+def replaced(doc: str) -> list:
+  els = cxt.parse(doc)
+  cxt.htmlReplace(els, cxt.htmlVars(els))
+  return els
+
+def zoaPy(els) -> list:
+  """Convert els to python lists of bytes (the shape of a zoa cxt tree)."""
+  out = []
+  for el in els:
+    attrs = []
+    for k, a in el.attrs.items():
+      attrs.extend((k.encode('utf-8'), a.body.encode('utf-8') if a else b''))
+    if isinstance(el, cxt.Text):
+      out.append([el.body.encode('utf-8'), bytes([el.tAttrs.value & 0xFF]), attrs])
+    else:
+      out.append([zoaPy(el.arr), bytes([el.cAttrs.value & 0xFF]), attrs])
+  return out
+
+def zoaRaw(doc: str) -> zoa.ZoaRaw:
+  return zoa.ZoaRaw.frPy(zoaPy(cxt.parse(doc)))
+
+def writeArr(z: zoa.ZoaRaw): zoa.write_arr(io.BytesIO(), z.arr)
+
+def varsEls(els): cxt.htmlReplace(els, cxt.htmlVars(els))
+
+def htmlEls(els):
+  for el in els: cxt._htmlStr(cxt.writeEl, el)
+
+def writeEls(els):
+  with tempfile.TemporaryFile('w') as f:
+    w = f.write
+    for el in els: cxt.writeEl(w, el)
+
+def editMiddle(doc: cxt.Doc):
+  """Insert a word in the middle of doc, i.e. a keystroke in an editor.
+
+  It is inserted at a line start, since the middle may be inside a command.
+  """
+  cxt.reparse(doc, doc.src.rfind('\n', 0, len(doc.src) // 2) + 1, 0, 'word ')
+
+STAGES = {
+  'parse':     (lambda doc: (doc,),                     cxt.parse),
+  'reparse':   (lambda doc: (cxt.parseDoc(doc),),       editMiddle),
+  'vars':      (lambda doc: (cxt.parse(doc),),          varsEls),
+  'html':      (lambda doc: (replaced(doc),),           htmlEls),
+  'write':     (lambda doc: (replaced(doc),),           writeEls),
+  'write_arr': (lambda doc: (zoaRaw(doc),),             writeArr),
+  'serialize': (lambda doc: (zoaRaw(doc),),             zoa.ZoaRaw.serialize),
+  'from_zoab': (lambda doc: (zoaRaw(doc).serialize(),), zoa.from_zoab),
+  'decode':    (lambda doc: (zoaRaw(doc).encode(),),    zoa.decode_zoab),
+  # export to (and load from) zoab, compare load against parse
+  'dumpZoab':  (lambda doc: (cxt.parse(doc),),          cxt.dumpZoab),
+  'loadZoab':  (lambda doc: (cxt.dumpZoab(cxt.parse(doc)),), cxt.loadZoab),
+}
+# The throughput of these stages is of the zoab bytes.
+ZOA_STAGES = ('write_arr', 'serialize', 'from_zoab', 'decode')
+
+def measure(setup, fn, doc, repeat):
+  """Return (best seconds, peak traced bytes) of fn(*setup(doc))."""
+  best = None
+  for _ in range(repeat):
+    args = setup(doc)
+    start = time.perf_counter()
+    fn(*args)
+    t = time.perf_counter() - start
+    if best is None or t < best: best = t
+
+  args = setup(doc)
+  tracemalloc.start()
+  try:
+    fn(*args)
+    peak = tracemalloc.get_traced_memory()[1]
+  finally: tracemalloc.stop()
+  return best, peak
+
+def treeStats(doc) -> dict:
+  """Memory used by the parsed tree and the blocks it allocated per KB."""
+  tracemalloc.start()
+  try:
+    before = tracemalloc.take_snapshot()
+    els = cxt.parse(doc)
+    mem = tracemalloc.get_traced_memory()[0]
+    after = tracemalloc.take_snapshot()
+  finally: tracemalloc.stop()
+  blocks = sum(s.count_diff for s in after.compare_to(before, 'filename'))
+  nodes = countNodes(els)
+  return {
+    'nodes': nodes,
+    'treeMB': mem / 1e6,
+    'bytesPerNode': mem / nodes,
+    'blocksPerKB': blocks / (len(doc) / 1024),
+  }
+
+def benchCorpus(name, size, stages, repeat) -> dict:
+  doc = CORPORA[name](size)
+  tree = treeStats(doc)
+  zoabBytes = len(zoaRaw(doc).serialize().getvalue())
+  print(f"## {name}: {len(doc):,} chars, {tree['nodes']:,} nodes,"
+        f" {tree['bytesPerNode']:.0f} B/node, {tree['blocksPerKB']:.0f} blocks/KB")
+  out = {'chars': len(doc), 'zoabBytes': zoabBytes, 'tree': tree, 'stages': {}}
+  for stage in stages:
+    setup, fn = STAGES[stage]
+    t, peak = measure(setup, fn, doc, repeat)
+    size = zoabBytes if stage in ZOA_STAGES else len(doc)
+    r = out['stages'][stage] = {
+      'seconds': t,
+      'MBps': size / 1e6 / t,
+      'nodesps': tree['nodes'] / t,
+      'peakMB': peak / 1e6,
+    }
+    print(f"  {stage:<10} {t:8.4f}s {r['MBps']:9.2f} MB/s"
+          f" {r['nodesps']:14,.0f} nodes/s {r['peakMB']:8.1f} MB peak")
+  return out
+
+def textRecords(n: int):
+  """n cxt Text records (as zoa types)."""
+  ArrText = cxt.zenv.arr(cxt.Text)
+  return ArrText(
+    cxt.Text(body=zoa.Str(f'word {i % 100}'), tAttrs=cxt.TAttrs(i & 0x70),
+             attrs=zoa.MapStrStr())
+    for i in range(n))
+
+def benchRecords(n: int, repeat: int) -> dict:
+  """Time toZ and frZ of n Text records."""
+  texts = textRecords(n)
+  print(f"## records: {n:,} Text")
+  out = {}
+  for name, setup, fn in [
+      ('toZ', lambda: (texts,),       lambda t: t.toZ()),
+      ('frZ', lambda: (texts.toZ(),), type(texts).frZ)]:
+    best = None
+    for _ in range(repeat):
+      args = setup()
+      start = time.perf_counter(); fn(*args); t = time.perf_counter() - start
+      if best is None or t < best: best = t
+    out[name] = {'seconds': best, 'recordsps': n / best}
+    print(f"  {name:<10} {best:8.4f}s {n / best:14,.0f} records/s")
+  return out
+
+def schemaText(n: int, forward=False) -> bytes:
+  """A zoa schema of n structs, each referring to the previous one.
+
+  If forward then all structs are declared first and each also refers to the
+  next one.
+  """
+  out = [b'declare S%d;\n' % i for i in range(n if forward else 1)]
+  for i in range(n):
+    out.append(b'struct S%d [ \\ struct %d\n'
+               b'  a: Int; b: Str\n  c: Arr[S%d]\n  d: Map[Str,Int]\n'
+               % (i, i, max(0, i - 1)))
+    if forward: out.append(b'  next: S%d; nexts: Arr[S%d]\n' % (2 * ((i + 1) % n,)))
+    out.append(b']\n')
+  return b''.join(out)
+
+def tokenize(schema: bytes):
+  p = zoa.Parser(schema)
+  while p.token(): pass
+
+def benchSchema(n: int, repeat: int) -> dict:
+  """Time tokenizing and parsing a schema of n structs.
+
+  forward parses the schema with forward declarations.
+  """
+  schema, forward = schemaText(n), schemaText(n, forward=True)
+  print(f"## schema: {n:,} structs, {len(schema):,} bytes")
+  out = {}
+  parse = lambda s: zoa.Parser(s).parse()
+  for name, fn, s in [('tokenize', tokenize, schema), ('parse', parse, schema),
+                      ('forward', parse, forward)]:
+    best = None
+    for _ in range(repeat):
+      start = time.perf_counter(); fn(s); t = time.perf_counter() - start
+      if best is None or t < best: best = t
+    out[name] = {'seconds': best, 'MBps': len(s) / 1e6 / best}
+    print(f"  {name:<10} {best:8.4f}s {len(s) / 1e6 / best:9.2f} MB/s")
+  return out
+
+def importTime(module: str) -> Tuple[float, float]:
+  """Return the (self, cumulative) seconds of importing module, as reported
+  by python -X importtime in a new process."""
+  err = subprocess.run(
+    [sys.executable, '-X', 'importtime', '-c', f'import {module}'],
+    capture_output=True, text=True, check=True,
+    cwd=os.path.dirname(os.path.abspath(__file__))).stderr
+  for line in err.splitlines(): # import time: self [us] | cumulative | name
+    times, _, name = line.partition(':')[2].rpartition('|')
+    if name.strip() == module:
+      selfUs, cumUs = times.split('|')
+      return int(selfUs) / 1e6, int(cumUs) / 1e6
+  raise ValueError(f"{module} not in output of -X importtime")
+
+def benchImport(repeat: int) -> dict:
+  """Time loading the cxt types (parsed and cached) and importing cxt."""
+  cacheDir = os.path.dirname(cache_from_source(os.path.abspath(cxt.__file__)))
+  importTime('cxt') # write the caches
+  print(f"## import")
+  out = {}
+  for name, fn in [
+      ('parse',  lambda: zoa.schemaEnv(cxt.TYPES, slots=True)),
+      ('cached', lambda: zoa.loadSchema(cxt.TYPES, cacheDir, slots=True)),
+      ('cxtSelf', lambda: importTime('cxt')[0]),
+      ('cxt',     lambda: importTime('cxt')[1])]:
+    best = None
+    for _ in range(max(repeat, 10)): # short and noisy
+      start = time.perf_counter(); t = fn()
+      if not isinstance(t, float): t = time.perf_counter() - start
+      if best is None or t < best: best = t
+    out[name] = {'seconds': best}
+    print(f"  {name:<10} {best * 1000:8.2f}ms")
+  return out
+
+def compare(prev, results):
+  print(f"## speedup compared to {prev.get('commit')} (>1 is faster)")
+  for name, corpus in results['corpora'].items():
+    for stage, r in corpus['stages'].items():
+      p = prev['corpora'].get(name, {}).get('stages', {}).get(stage)
+      if p: print(f"  {name:<7} {stage:<10} {p['seconds'] / r['seconds']:6.2f}x")
+  for kind in ('records', 'schema', 'import'):
+    for stage, r in results.get(kind, {}).items():
+      p = prev.get(kind, {}).get(stage)
+      if p: print(f"  {kind:<7} {stage:<10} {p['seconds'] / r['seconds']:6.2f}x")
+
+def gitCommit():
+  try:
+    return subprocess.run(
+      ['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+      cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+  except OSError: return None
+
+argP = argparse.ArgumentParser(description='cxt and zoa benchmarks.')
+argP.add_argument('--size', type=int, default=2_000_000,
+                  help="Approximate size (in chars) of generated documents.")
+argP.add_argument('--repeat', type=int, default=3,
+                  help="Times each stage is run (the best is kept).")
+argP.add_argument('--corpus', action='append', choices=list(CORPORA),
+                  help="Corpus to run (default all). Can be repeated.")
+argP.add_argument('--stage', action='append', choices=list(STAGES),
+                  help="Stage to run (default all). Can be repeated.")
+argP.add_argument('--records', type=int,
+                  help="Instead time toZ/frZ of this many Text records.")
+argP.add_argument('--schema', type=int,
+                  help="Instead time parsing a schema of this many structs.")
+argP.add_argument('--import', dest='importTime', action='store_true',
+                  help="Instead time loading the cxt types and importing cxt.")
+argP.add_argument('--json', help="Path to save the results to.")
+argP.add_argument('--compare', help="Path of previously saved results.")
+
+def main(args):
+  results = {
+    'commit': gitCommit(),
+    'python': platform.python_version(),
+    'size': args.size,
+    'corpora': {},
+  }
+  if args.records:
+    results['records'] = benchRecords(args.records, args.repeat)
+  if args.schema:
+    results['schema'] = benchSchema(args.schema, args.repeat)
+  if args.importTime:
+    results['import'] = benchImport(args.repeat)
+  if not (args.records or args.schema or args.importTime):
+    for name in args.corpus or CORPORA:
+      results['corpora'][name] = benchCorpus(
+        name, args.size, args.stage or STAGES, args.repeat)
+  if args.json:
+    with open(args.json, 'w') as f: json.dump(results, f, indent=1)
+    print("Saved results to:", args.json)
+  if args.compare:
+    with open(args.compare) as f: compare(json.load(f), results)
+
+if __name__ == '__main__':
+  main(argP.parse_args())
@@ -10,14 +10,19 @@ Copy and modify this file in any way you wish. Contributions are welcome.
 Version: 0.0.1
 """
 
-import copy
 import argparse
+import bisect
+import hashlib
+import json
 import os
 import re
+import signal
 import sys
+import time
 import html as pyHtml
 from dataclasses import dataclass, field
 from enum import Enum
+from importlib.util import cache_from_source
 
 import zoa
 from zoa import BaseParser
@@ -74,15 +79,19 @@ enum El [
 ]
 """
 
-zparser = zoa.Parser(TYPES)
-zparser.parse()
-tys = zparser.env.tys
+# Load the types precompiled (see zoa.loadSchema), cached with cxt's bytecode:
+# in sys.pycache_prefix if set and not written if PYTHONDONTWRITEBYTECODE is.
+zenv = zoa.loadSchema(TYPES, slots=True, write=not sys.dont_write_bytecode,
+  cacheDir=os.path.dirname(cache_from_source(os.path.abspath(__file__))))
+zenv.compile() # faster toZ/frZ
+tys = zenv.tys
 
 TAttrs = tys[b'TAttrs']
 CAttrs = tys[b'CAttrs']
 Text   = tys[b'Text']
 Cont   = tys[b'Cont']
 El     = tys[b'El']
+ArrEl  = Cont._fields[b'arr'].ty
 
 TOKEN_SPECIAL = {'[', ']', '='}
 CMD_BOOLEANS = ('b', 'i', '~')
@@ -90,6 +99,8 @@ CMD_BOOLEANS = ('b', 'i', '~')
 RE_CODE = re.compile('c|code|#+')
 RE_H = re.compile('h[123]')
 RE_ALNUM = re.compile('[0-9a-z_]', re.I)
+RE_SPACES = re.compile(' *')
+RE_PLAIN = re.compile(r'[^`@\[\]\n]+') # text without special characters
 
 emptyAttrs = dict()
 
@@ -107,11 +118,14 @@ def isHdr(name):  return RE_H.match(name)
 def isChng(name): return name in CMD_BOOLEANS
 
 def text(body, tAttrs=TAttrs(0), attrs=None):
+  """Create a Text element.
+
+  The tAttrs are interned and attrs is shared (not copied), so neither may be
+  modified afterwards.
+  """
   if not isinstance(body, str): body = body
-  if attrs is None: attrs = emptyAttrs
-  else: attrs = dict(attrs) # copy
-  tAttrs = TAttrs(tAttrs.value) # copy
-  return Text(body=body, tAttrs=tAttrs, attrs=attrs)
+  if not attrs: attrs = emptyAttrs
+  return Text(body=body, tAttrs=TAttrs.intern(tAttrs.value), attrs=attrs)
 
 def tx(text):
   if isinstance(text, str): return text
@@ -131,7 +145,7 @@ class Cmd:
 
 @dataclass
 class ParserState:
-  tAttrs: TAttrs = TAttrs(0)
+  tAttrs: TAttrs = TAttrs.intern(0)  # interned, never modified
   attrs: dict = field(default_factory=dict)
   out: list = field(default_factory=list)
 
@@ -194,17 +208,13 @@ class Parser:
         tx(self.body), tAttrs=self.s.tAttrs, attrs=self.s.attrs))
       self.body.clear()
 
-  def until(self, b: str):
-    out = []
-    i = 0
-    while i < len(b):
-      self.checkEof(self.notEof(), b)
-      c = self.buf[self.i]
-      if b[i] == c: i += 1;
-      else:         i = 0;
-      out.extend(c)
-      self.i += 1
-    return out[:-len(b)]
+  def until(self, b: str) -> str:
+    """Return the text up to the end marker b, consuming both."""
+    end = self.buf.find(b, self.i)
+    self.checkEof(end >= 0, b)
+    out = self.buf[self.i:end]
+    self.i = end + len(b)
+    return out
 
   def untilClose(self):
     while True:
@@ -292,9 +302,11 @@ class Parser:
       tAttrs=self.s.tAttrs,
       attrs=self.s.attrs))
     self.untilClose()
-    attrs = dict(self.s.attrs); attrs.update(cmd.attrs)
+    if self.s.attrs: attrs = dict(self.s.attrs); attrs.update(cmd.attrs)
+    else:            attrs = cmd.attrs or emptyAttrs
     cAttrs = CAttrs(cAttrs.value)
     if cmd.cAttrs.is_hide(): cAttrs.set_hide()
+    cAttrs = CAttrs.intern(cAttrs.value)
     prevS.out.append(Cont(arr=self.s.out, cAttrs=cAttrs, attrs=attrs))
     self.unrecurse(prevS)
 
@@ -303,17 +315,19 @@ class Parser:
     cmd.tAttrs.set_code()
     if cmd.name == '`': end = '`'
     else:               end = '[' + cmd.name + ']'
-    code = tx(self.until(end))
+    code = self.until(end)
     t = text(body=code, tAttrs=cmd.tAttrs, attrs=cmd.attrs)
     self.s.out.append(t)
     if 'set' in t.attrs or '\n' in t.body: return NOT_PG
 
   def parseChng(self, cmd):
     self.handleBody()
-    if   cmd.name == 'b': self.s.tAttrs.tog_b()
-    elif cmd.name == 'i': self.s.tAttrs.tog_i()
-    elif cmd.name == 'u': self.s.tAttrs.tog_u()
-    elif cmd.name == '~': self.s.tAttrs.tog_strike()
+    a = TAttrs(self.s.tAttrs.value) # copy, the state's tAttrs are interned
+    if   cmd.name == 'b': a.tog_b()
+    elif cmd.name == 'i': a.tog_i()
+    elif cmd.name == 'u': a.tog_u()
+    elif cmd.name == '~': a.tog_strike()
+    self.s.tAttrs = TAttrs.intern(a.value)
 
   def parseGet(self, cmd):
     self.handleBody()
@@ -326,7 +340,7 @@ class Parser:
 
   def parseRef(self, cmd):
     self.handleBody()
-    ref = tx(self.until('[/]'))
+    ref = self.until('[/]')
     a = dict(self.s.attrs)
     a.update(cmd.attrs)
     a['r'] = text(ref)
@@ -345,16 +359,16 @@ class Parser:
   # List
 
   def listNum(self, token):
+    start = self.i - len(token)
     while self.notEof():
       c = self.buf[self.i]; self.i += 1
       if '0' <= c <= '9':
-        token.append(c)
+        token += c
       elif c == '.':
         return token
-      else:
-       self.s.out.extend(token)
-       self.s.out.append(c)
-       return ''
+      else: # not a numbered item, parse it as text
+        self.i = start
+        return ''
 
   def listBox(self):
     c = self.buf[self.i]; self.i += 1
@@ -379,15 +393,16 @@ class Parser:
     if not token: return
     self.handleBody()
     c = CAttrs(0)
-    attrs = {}
+    attrs = emptyAttrs
     if token == '*':   c.set_star()
     elif token == '[ ]': c.set_nochk()
     elif token == '[X]': c.set_chk()
     elif '0' <= token[0] <= '9':
       c.set_num()
-      attrs['value'] = text(token)
+      attrs = {'value': text(token)}
     else: assert False, f"unreachable: {token}"
 
+    c = CAttrs.intern(c.value)
     l.append(Cont(arr=self.s.out, cAttrs=c, attrs=attrs))
     self.s.out = []
 
@@ -409,7 +424,7 @@ class Parser:
       close, pg = self.parseLine(pg)
       if close: break
     self.startBullet(l, lastToken)
-    c = CAttrs(0); c.set_list()
+    c = CAttrs(0); c.set_list(); c = CAttrs.intern(c.value)
     prevS.out.append(Cont(arr=l, cAttrs=c, attrs=cmd.attrs))
     self.unrecurse(prevS)
 
@@ -446,12 +461,13 @@ class Parser:
 
     Returns: closed, pg
     """
-    gotCloseBracket = False
     while self.notEof():
+      if pg is not IN_PG: # skip spaces
+        self.i = RE_SPACES.match(self.buf, self.i).end()
+        if not self.notEof(): break
       c = self.buf[self.i]
-      self.i += 1
-      if c == ' ' and pg is NOT_PG: continue # skip spaces
       if c == '\n':
+        self.i += 1
         if   pg is NOT_PG: pass # ignore extra '\n'
         elif pg is IN_PG: pg = END_PG_MAYBE
         elif pg is END_PG_MAYBE:
@@ -459,9 +475,14 @@ class Parser:
         else: assert False, f"unreachable: {pg}"
         return (False, pg)
       elif pg is END_PG_MAYBE: # previous line was '\n'
-        if c == ' ': continue # skip spaces
         self.body.append(' ')
       pg = IN_PG
+      m = RE_PLAIN.match(self.buf, self.i)
+      if m: # append the whole run of plain text
+        self.body.append(m.group())
+        self.i = m.end()
+        continue
+      self.i += 1
       if   c == '`': self.parseCode(self.newCmd('`'))
       elif c == '@': self.parseGet(self.newCmd('@'))
       elif c == '[':
@@ -471,7 +492,7 @@ class Parser:
         newPg = self.doCmd(cmd)
         if newPg is not None: pg = newPg
       elif c == ']': self.parseCloseBracket()
-      else: self.body.append(c)
+      else: assert False, f"unreachable: {c}"
     return (False, pg)
 
   def parse(self, pg=IN_PG):
@@ -481,6 +502,23 @@ class Parser:
     self.handleBody()
     return self.s.out
 
+  def parseMarked(self, pg=IN_PG, stop=None):
+    """Parse the top level like parse(), returning the Marks between lines.
+
+    stop(mark) is called with each mark; if it returns True parsing stops
+    there (with the pending state discarded).
+    """
+    marks = []
+    while self.notEof():
+      if not self.body:
+        m = Mark(self.i, len(self.s.out), pg, self.s.tAttrs)
+        marks.append(m)
+        if stop and stop(m): return marks
+      close, pg = self.parseLine(pg)
+      if close: self.error("Unexpected [/]")
+    self.handleBody()
+    return marks
+
 
 def parse(b: str) -> list:
   p = Parser(b)
@@ -488,172 +526,779 @@ def parse(b: str) -> list:
   if out is None: p.error("Unexpected [/]")
   return out
 
-def htmlCode(start, end, el):
+####################
+# Incremental parsing
+#
+# Block elements (headers, lists, quotes, code blocks, ...) flush the pending
+# text, so the top level lines after them start from a clean state. Parsing
+# from such a point only depends on the text after it, the paragraph state
+# and the text attributes, so an edit is reparsed from the last Mark before
+# it until the parser reaches an old Mark (after the edit) in the same state,
+# and the old elements after it are kept.
+#
+# The marks are a gap buffer at the last edit: the ones before it have their
+# offsets from the start and the ones after it (in reverse) from the end, which
+# an edit doesn't change. Only the marks between two edits are converted.
+
+@dataclass
+class Mark:
+  """A top level line start with no pending text."""
+  i: int          # source offset
+  n: int          # number of top level elements before it
+  pg: Pg
+  tAttrs: TAttrs  # interned
+
+@dataclass
+class Doc:
+  """A parsed document which can be incrementally reparsed with reparse().
+
+  The elements are kept by reparse, so they must not be modified: html()
+  replaces variables in place, use Doc.html().
+  """
+  src: str
+  els: list
+  head: list  # Marks before the gap, by increasing i
+  tail: list  # Marks after the gap, with i and n from the end, by increasing i
+
+  def _moveGap(self, offset):
+    """Move the gap to after the last mark at or before offset."""
+    head, tail, size, nEls = self.head, self.tail, len(self.src), len(self.els)
+    while head and head[-1].i > offset:
+      m = head.pop(); m.i = size - m.i; m.n = nEls - m.n; tail.append(m)
+    while tail and size - tail[-1].i <= offset:
+      m = tail.pop(); m.i = size - m.i; m.n = nEls - m.n; head.append(m)
+
+  def marks(self) -> list[Mark]:
+    """Return copies of all the marks, with offsets from the start."""
+    size, nEls = len(self.src), len(self.els)
+    return [Mark(m.i, m.n, m.pg, m.tAttrs) for m in self.head] + [
+      Mark(size - m.i, nEls - m.n, m.pg, m.tAttrs) for m in reversed(self.tail)]
+
+  def span(self, index) -> tuple[int, int]:
+    """Return the source (start, end) of the block containing the top level
+    element at index. A block may hold several elements."""
+    head, tail, size = self.head, self.tail, len(self.src)
+    k = bisect.bisect_right(head, index, key=lambda m: m.n)
+    if k < len(head): return head[k - 1].i, head[k].i
+    # the marks in tail[j:] are before the element
+    j = bisect.bisect_left(tail, len(self.els) - index, key=lambda m: m.n)
+    if j == len(tail):
+      return head[-1].i, size - tail[-1].i if tail else size
+    return size - tail[j].i, size - tail[j - 1].i if j else size
+
+  def html(self) -> list[str]:
+    return html([copyEl(el) for el in self.els])
+
+def copyEl(el: El) -> El:
+  """Copy the Text and Cont nodes of el (but not their attrs)."""
+  if isinstance(el, Text):
+    return Text(body=el.body, tAttrs=el.tAttrs, attrs=el.attrs)
+  return Cont(arr=[copyEl(c) for c in el.arr], cAttrs=el.cAttrs, attrs=el.attrs)
+
+def parseDoc(b: str) -> Doc:
+  p = Parser(b)
+  marks = p.parseMarked()
+  return Doc(b, p.s.out, marks, [])
+
+def reparse(doc: Doc, offset: int, deleted: int, inserted: str) -> Doc:
+  """Replace `deleted` chars at offset of the doc with inserted, reparsing only
+  the blocks the edit touches. The doc is edited in place and returned.
+
+  When there is no block boundary before (or after) the edit this parses from
+  the start (or to the end) of the document. If the edited source doesn't
+  parse the error is raised and doc is unchanged.
+  """
+  src = doc.src
+  if not 0 <= offset <= offset + deleted <= len(src):
+    raise IndexError(f"edit out of range: {offset}+{deleted} of {len(src)}")
+  if not (deleted or inserted): return doc
+  new = src[:offset] + inserted + src[offset + deleted:]
+  if not doc.head: # empty
+    new = parseDoc(new)
+    doc.src, doc.els, doc.head, doc.tail = new.src, new.els, new.head, new.tail
+    return doc
+
+  doc._moveGap(offset)
+  head, tail, start = doc.head, doc.tail, doc.head[-1]
+  t = len(tail) - 1 # the next old mark
+  while t >= 0 and len(src) - tail[t].i < offset + deleted: t -= 1 # deleted
+  same = False
+  def stop(m):
+    nonlocal t, same
+    while t >= 0 and len(new) - tail[t].i < m.i: t -= 1
+    if t < 0: return False
+    o = tail[t]
+    same = len(new) - o.i == m.i and o.pg is m.pg and o.tAttrs is m.tAttrs
+    return same
+
+  p = Parser(new, i=start.i, s=ParserState(tAttrs=start.tAttrs))
+  marks = p.parseMarked(start.pg, stop)
+  if same: # keep the old elements and marks after the edit
+    marks.pop()
+    doc.els[start.n:len(doc.els) - tail[t].n] = p.s.out
+    del tail[t + 1:]
+  else:
+    doc.els[start.n:] = p.s.out
+    tail.clear()
+  head.pop()
+  for m in marks: m.n += start.n
+  head.extend(marks)
+  doc.src = new
+  return doc
+
+# The html writers take a write function `w` (i.e. `file.write` or
+# `list.append`) and stream the html for an element to it.
+
+def htmlCode(w, end, el):
   if not el.tAttrs.is_code(): return False
   if '\n' in el.body:
-    start.append('<pre>');  end.append('</pre>')
+    w('<pre>');  end.append('</pre>')
   else:
-    start.append('<code>'); end.append('</code>')
+    w('<code>'); end.append('</code>')
   return True
 
-def htmlRef(start, end, el):
+def htmlRef(w, end, el):
   ref = el.attrs.get('r')
   if ref:
-    start.append(f'<a href="{ref.body}">')
+    w(f'<a href="{ref.body}">')
     end.append('</a>')
 
-def htmlText(t: Text) -> str:
+def writeText(w, t: Text):
   a = t.tAttrs
-  if a.is_get(): return ''
-  start = []
-
+  if a.is_get(): return
   end = []
   if a.is_b():
-    start.append('<b>'); end.append('</b>')
+    w('<b>'); end.append('</b>')
   if a.is_i():
-    start.append('<i>'); end.append('</i>')
+    w('<i>'); end.append('</i>')
   if a.is_u():
-    start.append('<u>'); end.append('</u>')
+    w('<u>'); end.append('</u>')
   if a.is_strike():
-    start.append('<s>'); end.append('</s>')
-  htmlRef(start, end, t)
-  if htmlCode(start, end, t):
+    w('<s>'); end.append('</s>')
+  htmlRef(w, end, t)
+  if htmlCode(w, end, t):
     text = pyHtml.escape(t.body)
     if text[0] == '\n': text = text[1:]
-    text = '<br>'.join(text.split('\n'))
+    w('<br>'.join(text.split('\n')))
   else:
-    text = '</p><p>'.join(pyHtml.escape(i) for i in t.body.split('\n'))
-  return tx(start) + text + tx(end)
-
-def _htmlCont(cont: Cont, endStart=None):
-  start = []; end = []
-  htmlRef(start, end, cont)
-  out = []
-  for el in cont.arr:
-    if isinstance(el, Text): out.append(htmlText(el))
-    else                   : out.append(htmlCont(el))
+    w('</p><p>'.join(pyHtml.escape(i) for i in t.body.split('\n')))
+  for e in end: w(e)
 
-  if endStart: start.extend(endStart)
-  return '>' + tx(start) + tx(out) + tx(end)
+def _writeCont(w, cont: Cont, endStart=None):
+  end = []
+  w('>')
+  htmlRef(w, end, cont)
+  if endStart: w(endStart)
+  for el in cont.arr: writeEl(w, el)
+  for e in end: w(e)
 
 def liIsOrdered(c: CAttrs):
   if c.is_star():    return False
   elif c.is_num():   return True
   elif c.is_nochk(): return False
   elif c.is_chk():   return False
-  else: assert False, f'unexpected: {li}'
+  else: assert False, f'unexpected: {c}'
 
-def htmlList(cont: Cont):
-  out = []
+def writeList(w, cont: Cont):
   if not cont.arr: return
   ordered = liIsOrdered(cont.arr[0].cAttrs)
-  if ordered: start = '<ol>'; end = '</ol>'
-  else:       start = '<ul>'; end = '</ul>'
+  if ordered: w('<ol>'); end = '</ol>'
+  else:       w('<ul>'); end = '</ul>'
 
   for li in cont.arr:
     if liIsOrdered(li.cAttrs) != ordered:
       raise ValueError(f"change in ordering: {li}")
-    if ordered: ls = f'<li value="{li.attrs["value"].body}"'
-    else:       ls = f'<li'
-    endStart = []
-    if li.cAttrs.is_chk():     endStart.append('✅ ')
-    elif li.cAttrs.is_nochk(): endStart.append('🔲 ')
-    out.append(ls + _htmlCont(li, endStart) + '</li>')
-  return start + tx(out) + end
-
-def htmlCont(cont: Cont) -> str:
+    if ordered: w(f'<li value="{li.attrs["value"].body}"')
+    else:       w('<li')
+    endStart = None
+    if li.cAttrs.is_chk():     endStart = '✅ '
+    elif li.cAttrs.is_nochk(): endStart = '🔲 '
+    _writeCont(w, li, endStart)
+    w('</li>')
+  w(end)
+
+def _writeTag(w, tag, cont: Cont):
+  w('<' + tag); _writeCont(w, cont); w('</' + tag + '>')
+
+def writeCont(w, cont: Cont):
   c = cont.cAttrs
-  if c.is_hide() or 'set' in cont.attrs: return ''
-  if c.is_t() : return '<span' + _htmlCont(cont) + '</span>'
-  if c.is_h1(): return '<h1'  + _htmlCont(cont) + '</h1>'
-  if c.is_h2(): return '<h2'  + _htmlCont(cont) + '</h2>'
-  if c.is_h3(): return '<h3'  + _htmlCont(cont) + '</h3>'
-  if c.is_list(): return htmlList(cont)
-  if c.is_quote(): return '<blockquote' + _htmlCont(cont) + '</blockquote>'
+  if c.is_hide() or 'set' in cont.attrs: return
+  if c.is_t() :    _writeTag(w, 'span', cont)
+  elif c.is_h1():  _writeTag(w, 'h1', cont)
+  elif c.is_h2():  _writeTag(w, 'h2', cont)
+  elif c.is_h3():  _writeTag(w, 'h3', cont)
+  elif c.is_list(): writeList(w, cont)
+  elif c.is_quote(): _writeTag(w, 'blockquote', cont)
+
+def writeEl(w, el: El):
+  if isinstance(el, Text):       writeText(w, el)
+  elif isinstance(el, Cont):     writeCont(w, el)
+  elif isinstance(el, Fragment): el.write(w)
+  else: raise TypeError(el)
+
+def _htmlStr(write, el) -> str:
+  out = []; write(out.append, el)
+  return tx(out)
+
+def htmlText(t: Text) -> str:    return _htmlStr(writeText, t)
+def htmlCont(cont: Cont) -> str: return _htmlStr(writeCont, cont)
+def htmlList(cont: Cont) -> str: return _htmlStr(writeList, cont)
+
+def unsetVar(el: El) -> El:
+  """Return a shallow copy of el without its set= attr.
+
+  The copy shares its children with el.
+  """
+  attrs = dict(el.attrs); attrs.pop('set')
+  if isinstance(el, Text):
+    return Text(body=el.body, tAttrs=el.tAttrs, attrs=attrs)
+  return Cont(arr=el.arr, cAttrs=el.cAttrs, attrs=attrs)
+
+@dataclass
+class Fragment:
+  """A set= variable, shared by all of its @references.
+
+  The html of an element only depends on the element itself (text attributes
+  are resolved while parsing), so it is rendered once and then reused.
+  """
+  el: El
+  html: str = None
+  text: Text = None
+
+  def write(self, w):
+    if self.html is None: self.html = _htmlStr(writeEl, self.el)
+    w(self.html)
+
+  def attrText(self, name) -> Text:
+    """Return the variable as a single Text, for use as attr name."""
+    if self.text is None:
+      el = self.el
+      if isinstance(el, Cont):
+        if len(el.arr) != 1 or not isinstance(el.arr[0], Text):
+          raise ValueError(f"vars used as attr must have single Text item: {name}")
+        el = el.arr[0]
+      self.text = el
+    return self.text
 
 def htmlVars(els, vars=None):
   if vars is None: vars = {}
   for el in els:
+    if isinstance(el, Fragment): continue # already replaced
     name = el.attrs.get('set')
     if name is not None:
       name = name.body
       if name in vars:
         raise ValueError(f"{name} is set more than once")
-      el = copy.deepcopy(el)
-      el.attrs.pop('set')
-      vars[name] = el
-    if isinstance(el, Cont): htmlVars(el.arr)
+      vars[name] = Fragment(unsetVar(el))
+    if isinstance(el, Cont): htmlVars(el.arr, vars)
   return vars
 
 def replaceVar(vars, el, requireStr=False, name=None):
+  """Return the variable el refers to (or el if it is not an @get).
+
+  Variables are not copied: every reference shares the same Fragment.
+  """
   if requireStr and not isinstance(el, Text):
     raise ValueError(f"vars used as attr must be Text type: {name}")
 
   if isinstance(el, Text) and el.tAttrs.is_get():
     var = vars[el.body]
-    if requireStr:
-      if isinstance(var, Cont):
-        if len(var.arr) != 1 or not isinstance(var.arr[0], Text):
-          raise ValueError(f"vars used as attr must have single Text item: {name}")
-      var = copy.deepcopy(var.arr[0])
-    else: var = copy.deepcopy(var)
-    el = var
+    if requireStr: return var.attrText(name)
+    return var
   return el
 
 def htmlReplace(els, vars):
   for i, el in enumerate(els):
+    if isinstance(el, Fragment): continue # already replaced
     els[i] = replaceVar(vars, el)
 
+    # attrs may be shared between elements, so copy them on write
+    attrs = None
     for aname, attr in el.attrs.items():
-      el.attrs[aname] = replaceVar(vars, attr, requireStr=True, name=aname)
-
-    if isinstance(el, Cont):
+      v = replaceVar(vars, attr, requireStr=True, name=aname)
+      if v is attr: continue
+      if attrs is None: attrs = dict(el.attrs)
+      attrs[aname] = v
+    if attrs is not None: el.attrs = attrs
+
+    # The children of set= containers are shared with their variable, which
+    # are never modified.
+    if isinstance(el, Cont) and 'set' not in el.attrs:
       htmlReplace(el.arr, vars)
 
-def html(els: list[El]):
+def html(els: list[El]) -> list[str]:
+  """Return the html of each (top level) element."""
   vars = htmlVars(els)
   htmlReplace(els, vars)
+  return [_htmlStr(writeEl, el) for el in els]
 
-  out = []
+def htmlWrite(f, els: list[El], sep=''):
+  """Stream the html of els to the text file f.
+
+  Unlike html() the output is never held in memory. sep is written after
+  each top level element.
+  """
+  vars = htmlVars(els)
+  htmlReplace(els, vars)
+  w = f.write
   for el in els:
-    if isinstance(el, Text):   out.append(htmlText(el))
-    elif isinstance(el, Cont): out.append(htmlCont(el))
-    else: raise TypeError(el)
+    writeEl(w, el)
+    if sep: w(sep)
+
+# Export to zoab using the zoa TYPES. The parsed elements are converted to
+# the types (with El variants and Str attrs) and back. loadZoab decodes the
+# zoab directly to parsed elements instead (it is faster than parsing).
+#
+# Attr values are exported the way they are written: an @get as '@name' and
+# an attr without a value as ''. A literal value which is empty or starts with
+# '@' or '\' is escaped with a leading '\' (i.e. [r]@foo[/] as '\@foo').
+
+def zoaAttrs(attrs: dict) -> MapStrStr:
+  out = MapStrStr()
+  for name, v in attrs.items():
+    if v is None:           v = ''
+    elif v.tAttrs.is_get(): v = '@' + v.body
+    elif not v.body or v.body[0] in '@\\': v = '\\' + v.body
+    else:                   v = v.body
+    out[zoa.Str(name)] = zoa.Str(v)
+  return out
 
+def cxtAttr(v: str):
+  if not v:             return None
+  elif v[0] == '@':     return text(str(v[1:]), TGet)
+  elif v[0] == '\\':    return text(str(v[1:]))
+  else:                 return text(str(v))
+
+def cxtAttrs(attrs: MapStrStr) -> dict:
+  if not attrs: return emptyAttrs
+  return {str(name): cxtAttr(v) for name, v in attrs.items()}
+
+def zoaEl(el) -> El:
+  """Convert a parsed element to the El type."""
+  if isinstance(el, Text):
+    return El(text=Text(
+      body=zoa.Str(el.body), tAttrs=el.tAttrs, attrs=zoaAttrs(el.attrs)))
+  return El(cont=Cont(
+    arr=ArrEl(zoaEl(e) for e in el.arr), cAttrs=el.cAttrs,
+    attrs=zoaAttrs(el.attrs)))
+
+def cxtEl(el: El):
+  """Convert an El to a parsed element (the inverse of zoaEl)."""
+  if el.text is not None:
+    t = el.text
+    return text(str(t.body), t.tAttrs, cxtAttrs(t.attrs))
+  c = el.cont
+  return Cont(arr=[cxtEl(e) for e in c.arr],
+              cAttrs=CAttrs.intern(c.cAttrs.value), attrs=cxtAttrs(c.attrs))
+
+def dumpZoab(els: list) -> bytearray:
+  """Return the zoab (an Arr[El]) of the parsed els."""
+  return ArrEl(zoaEl(el) for el in els).toZ().encode()
+
+def loadZoab(b) -> list:
+  """Return the parsed elements of the zoab b (see dumpZoab).
+
+  This is the same as converting ArrEl.frZ(zoa.decode_zoab(b)[0]) with cxtEl
+  but decodes b directly. The Text and Cont must have all their fields.
+  """
+  out = []
+  try: end = loadArr(b, 0, out)
+  except IndexError: raise zoa.Eof()
+  if end > len(b): raise zoa.Eof() # the last data was cut off
   return out
 
+def loadData(b, i: int):
+  """Return the data at b[i] and the index after it.
+
+  The index can be past the end of b if the data is cut off (see loadZoab).
+  """
+  meta = b[i]
+  if meta < zoa.ZOA_ARR: return b[i+1:i+1+meta], i + 1 + meta # not joined
+  return zoa.decode_data(b, i)
+
+def loadArr(b, i: int, out: list) -> int:
+  """Append the elements of the Arr[El] at b[i] to out, returning its end."""
+  meta = b[i]; i += 1
+  while True:
+    if not meta & zoa.ZOA_ARR: raise ValueError(f"expected Arr[El] at {i-1}")
+    for _ in range(meta & zoa.ZOA_LEN_MASK):
+      el, i = loadEl(b, i); out.append(el)
+    if not meta & zoa.ZOA_JOIN: return i
+    meta = b[i]; i += 1
+
+def loadAttrs(b, i: int):
+  """Return the attrs of the MapStrStr at b[i] and the index after it."""
+  meta = b[i]; i += 1
+  if meta == zoa.ZOA_ARR: return emptyAttrs, i # common: no attrs
+  items = []
+  while True:
+    if not meta & zoa.ZOA_ARR: raise ValueError(f"expected MapStrStr at {i-1}")
+    for _ in range(meta & zoa.ZOA_LEN_MASK):
+      v, i = loadData(b, i); items.append(str(v, 'utf-8'))
+    if not meta & zoa.ZOA_JOIN: break
+    meta = b[i]; i += 1
+  if len(items) % 2: raise ValueError(f"MapStrStr length not even: {items}")
+  return {items[a]: cxtAttr(items[a+1]) for a in range(0, len(items), 2)}, i
+
+# The start of an El as dumpZoab writes it: arr[variant, arr[3, fields...]]
+TEXT_START = bytes((zoa.ZOA_ARR | 2, 1, 0, zoa.ZOA_ARR | 4, 1, 3))
+CONT_START = bytes((zoa.ZOA_ARR | 2, 1, 1, zoa.ZOA_ARR | 4, 1, 3))
+
+def loadElStart(b, i: int):
+  """Return the variant of the El at b[i] and the index of its fields."""
+  if b[i] != zoa.ZOA_ARR | 2: raise ValueError(f"expected El at {i}")
+  variant, i = loadData(b, i + 1)
+  if b[i] != zoa.ZOA_ARR | 4: raise ValueError(f"expected Text or Cont at {i}")
+  posArgs, i = loadData(b, i + 1)
+  if i > len(b): raise zoa.Eof()
+  if int.from_bytes(posArgs, 'big') != 3:
+    raise ValueError(f"expected 3 fields at {i}, got {bytes(posArgs)}")
+  return int.from_bytes(variant, 'big'), i
+
+def loadEl(b, i: int):
+  """Return the El at b[i] as a parsed element and the index after it."""
+  start = b[i:i+6]
+  if   start == TEXT_START: variant = 0; i += 6
+  elif start == CONT_START: variant = 1; i += 6
+  else:                     variant, i = loadElStart(b, i)
+  # loadData and loadAttrs are inlined for their common cases
+  if variant == 0:
+    m = b[i]; j = i + 1 + m
+    body, i = (b[i+1:j], j) if m < zoa.ZOA_ARR else zoa.decode_data(b, i)
+    m = b[i]; j = i + 1 + m
+    tAttrs, i = (b[i+1:j], j) if m < zoa.ZOA_ARR else zoa.decode_data(b, i)
+    if b[i] == zoa.ZOA_ARR: attrs = emptyAttrs; i += 1
+    else:                   attrs, i = loadAttrs(b, i)
+    return Text(str(body, 'utf-8'),
+                TAttrs.intern(int.from_bytes(tAttrs, 'big')), attrs), i
+  if variant != 1: raise ValueError(f"unknown El variant {variant}")
+  arr = []; i = loadArr(b, i, arr)
+  cAttrs, i = loadData(b, i)
+  attrs, i = loadAttrs(b, i)
+  return Cont(arr, CAttrs.intern(int.from_bytes(cAttrs, 'big')), attrs), i
+
+
+####################
+# Render server
+#
+# python3 cxt.py --serve ADDR keeps the parser and types warm: POST /html with
+# .cxt source as the body returns its html. Rendering is done in a pool of
+# worker processes so concurrent requests use all cores.
+#
+# asyncio is imported by the functions using it, since it is slow to import.
+
+MAX_BODY = 64 * 1024 * 1024
+HTTP_REASONS = {
+  200: 'OK', 400: 'Bad Request', 404: 'Not Found', 405: 'Method Not Allowed',
+  411: 'Length Required', 413: 'Payload Too Large',
+  500: 'Internal Server Error',
+}
+
+def renderHtml(src: str):
+  """Return (html, error) of the cxt source, run by the server's workers."""
+  try: return '\n'.join(html(parse(src))), None
+  except Exception as e: return None, f'{type(e).__name__}: {e}'
+
+def parseAddr(addr: str):
+  """Return (host, port) of 'HOST:PORT' or the path of a unix socket."""
+  host, _, port = addr.rpartition(':')
+  if host and port.isdigit(): return host, int(port)
+  return addr
+
+async def _readRequest(reader):
+  """Return (method, target, keepAlive, length, body) or None if the client is
+  done. body is None if it wasn't read (it is missing or too large)."""
+  import asyncio
+  try: head = await reader.readuntil(b'\r\n\r\n')
+  except (asyncio.IncompleteReadError, asyncio.LimitOverrunError): return None
+  lines = head.decode('latin-1').split('\r\n')
+  method, target, version = lines[0].split(' ', 2)
+  headers = {}
+  for line in lines[1:]:
+    k, _, v = line.partition(':')
+    if k: headers[k.strip().lower()] = v.strip()
+  conn = headers.get('connection', '').lower()
+  keepAlive = conn == 'keep-alive' if version == 'HTTP/1.0' else conn != 'close'
+  length = headers.get('content-length')
+  if length is not None: length = int(length)
+  if length is None: body = None if method == 'POST' else b''
+  elif length > MAX_BODY: body = None
+  else: body = await reader.readexactly(length)
+  if body is None: keepAlive = False # the rest of the request is unread
+  return method, target, keepAlive, length, body
+
+def _response(status: int, body: bytes, keepAlive: bool) -> bytes:
+  """The response: html if status is 200, else a text error."""
+  ctype = 'text/html' if status == 200 else 'text/plain'
+  return (f'HTTP/1.1 {status} {HTTP_REASONS[status]}\r\n'
+          f'Content-Type: {ctype}; charset=utf-8\r\nContent-Length: {len(body)}\r\n'
+          f'Connection: {"keep-alive" if keepAlive else "close"}\r\n\r\n'
+          ).encode('latin-1') + body
+
+async def _handle(render, method, target, length, body):
+  """Return (status, body) of a request."""
+  from concurrent.futures import BrokenExecutor
+  if target.split('?')[0] != '/html': return 404, b'Not found\n'
+  if method != 'POST':                return 405, b'Use POST\n'
+  if length is None: return 411, b'Content-Length is required\n'
+  if body is None:   return 413, b'Body too large\n'
+  try: src = body.decode('utf-8')
+  except UnicodeDecodeError: return 400, b'Body is not utf-8\n'
+  try: out, err = await render(src)
+  except BrokenExecutor: return 500, b'The render worker died\n'
+  if err: return 400, (err + '\n').encode('utf-8')
+  return 200, out.encode('utf-8')
+
+async def _serveConn(render, reader, writer):
+  try:
+    while True:
+      req = await _readRequest(reader)
+      if req is None: break
+      method, target, keepAlive, length, body = req
+      status, out = await _handle(render, method, target, length, body)
+      writer.write(_response(status, out, keepAlive))
+      await writer.drain()
+      if not keepAlive: break
+  except (ConnectionError, EOFError, ValueError): pass # reset, cut or malformed
+  finally: writer.close()
+
+async def startServer(addr: str, pool=None, newPool=None):
+  """Start the render server at addr, rendering in pool (an Executor).
+
+  If pool is None then rendering is done in this process. If a worker dies the
+  request gets a 500 response and pool is replaced with newPool() (if given).
+  """
+  import asyncio
+  from concurrent.futures import BrokenExecutor
+  loop = asyncio.get_running_loop()
+  if pool is None:
+    async def render(src): return renderHtml(src)
+  else:
+    async def render(src):
+      nonlocal pool
+      p = pool
+      try: return await loop.run_in_executor(p, renderHtml, src)
+      except BrokenExecutor:
+        if newPool and pool is p: pool = newPool()
+        raise
+  handle = lambda r, w: _serveConn(render, r, w)
+  addr = parseAddr(addr)
+  if isinstance(addr, tuple): return await asyncio.start_server(handle, *addr)
+  return await asyncio.start_unix_server(handle, addr)
+
+def _resetSignals():
+  """Initialize a worker forked from the server: it would otherwise wake the
+  server's event loop on SIGTERM instead of exiting."""
+  signal.set_wakeup_fd(-1)
+  signal.signal(signal.SIGTERM, signal.SIG_DFL)
+
+def serve(addr: str, jobs=None):
+  """Run the render server at addr until SIGINT or SIGTERM, see startServer.
+
+  The workers are shut down before returning.
+  """
+  import asyncio
+  from concurrent.futures import ProcessPoolExecutor
+  pools = [] # replaced when broken, the last is in use
+  def newPool():
+    pools.append(ProcessPoolExecutor(jobs, initializer=_resetSignals))
+    return pools[-1]
+
+  async def run():
+    loop = asyncio.get_running_loop()
+    pool = newPool() if jobs != 1 else None
+    server = await startServer(addr, pool, newPool)
+    if pool: await loop.run_in_executor(pool, renderHtml, '') # start the workers
+    stop = asyncio.Event()
+    loop.add_signal_handler(signal.SIGTERM, stop.set)
+    print(f"Serving cxt at {addr} with {jobs or os.cpu_count()} workers", flush=True)
+    async with server: await stop.wait()
+  try: asyncio.run(run())
+  except KeyboardInterrupt: pass
+  finally:
+    for pool in pools: pool.shutdown(cancel_futures=True)
+
 
 argP = argparse.ArgumentParser(description='cxt documentation markup language.')
-argP.add_argument('path', help="Path to file or directory.")
-argP.add_argument('export', help="Path to export file.")
+argP.add_argument('path', nargs='?', help="Path to file or directory.")
+argP.add_argument('export', nargs='?', help="Path to export file (or directory).")
+argP.add_argument('-j', '--jobs', type=int, default=os.cpu_count(),
+                  help="Number of processes used when path is a directory"
+                       " (or by --serve).")
+argP.add_argument('--serve', metavar='ADDR',
+                  help="Instead run a render server at HOST:PORT or a unix"
+                       " socket path: POST /html with .cxt source returns html.")
+argP.add_argument('--ext', default='.html',
+                  help="Type of exported files when path is a directory.")
+argP.add_argument('--force', action='store_true',
+                  help="Export all files, even ones unchanged since last export.")
+
+EXPORT_EXTS = ('.html', '.md', '.zoab')
 
 def syserr(msg):
   print("Error:", msg)
   sys.exit(1)
 
-def cxtHtml(pth):
-  if not pth.endswith('.cxt'): syserror("Can only process .cxt files")
+def cxtParse(pth):
+  """Parse the .cxt file (or load the exported .zoab file) at pth."""
+  if pth.endswith('.zoab'):
+    with open(pth, 'rb') as f: return loadZoab(f.read())
+  if not pth.endswith('.cxt'): syserr("Can only process .cxt or .zoab files")
   with open(pth, 'r') as f: b = f.read()
-  els = parse(b)
-  return html(els)
+  return parse(b)
 
-def main(args):
-  h = cxtHtml(args.path)
+def cxtHtml(pth): return html(cxtParse(pth))
+
+def export(path, exportPath):
+  """Export the .cxt file at path to exportPath (.html, .md or .zoab)."""
+  els = cxtParse(path)
+  if exportPath.endswith('.zoab'):
+    with open(exportPath, 'wb') as f: f.write(dumpZoab(els))
+    return
   end = []
-  with open(args.export, 'w') as f:
-    if args.export.endswith('.html'):
+  with open(exportPath, 'w') as f:
+    if exportPath.endswith('.html'):
       f.write('<!DOCTYPE html>\n<html><body><p>\n')
       end.append('</p></body></html>\n')
-    elif args.export.endswith('.md'):
+    elif exportPath.endswith('.md'):
       f.write('<div>\n'); end.append('</div>')
-    else: syserror(f"Unknown file type. Supported are: .html, .md")
+    else: syserr(f"Unknown file type. Supported are: {', '.join(EXPORT_EXTS)}")
 
-    f.write(f'<!-- Generated by cxt.py from {args.path} -->\n')
-    for l in h:
-      f.write(l); f.write('\n')
+    f.write(f'<!-- Generated by cxt.py from {path} -->\n')
+    htmlWrite(f, els, sep='\n')
     for l in end:
       f.write(l); f.write('\n')
     f.flush()
+
+def _exportTimed(path, exportPath):
+  """Export path, returning (seconds, error).
+
+  Errors are returned as strings since they are sent between processes.
+  """
+  start = time.perf_counter()
+  try: export(path, exportPath); err = None
+  except Exception as e: err = f'{type(e).__name__}: {e}'
+  return time.perf_counter() - start, err
+
+def findCxt(root):
+  """Yield the paths of all .cxt files under root (sorted)."""
+  for dirpath, dirnames, filenames in os.walk(root):
+    dirnames.sort()
+    for name in sorted(filenames):
+      if name.endswith('.cxt'): yield os.path.join(dirpath, name)
+
+def exportPaths(root, exportRoot, ext='.html'):
+  """Return [(path, exportPath)] for root's .cxt files mirrored in exportRoot."""
+  out = []
+  for path in findCxt(root):
+    rel = os.path.relpath(path, root)[:-len('.cxt')]
+    out.append((path, os.path.join(exportRoot, rel + ext)))
+  return out
+
+MANIFEST = '.cxt-manifest.json'
+
+def toolHash() -> str:
+  """Hash of the cxt.py and zoa.py sources.
+
+  This is part of every manifest hash so that changing either rebuilds.
+  """
+  h = hashlib.sha256()
+  for mod in (__file__, zoa.__file__):
+    with open(mod, 'rb') as f: h.update(f.read())
+  return h.hexdigest()
+
+def sourceHash(path, tool: str) -> str:
+  h = hashlib.sha256(tool.encode('utf-8'))
+  with open(path, 'rb') as f: h.update(f.read())
+  return h.hexdigest()
+
+def loadManifest(path) -> dict:
+  try:
+    with open(path) as f: return json.load(f)
+  except (FileNotFoundError, ValueError): return {}
+
+def saveManifest(path, manifest: dict):
+  tmp = path + '.tmp'
+  with open(tmp, 'w') as f: json.dump(manifest, f, indent=1, sort_keys=True)
+  os.replace(tmp, path)
+
+def isFresh(entry, hsh, exportPath) -> bool:
+  """Return whether the manifest entry is an up to date export."""
+  if not entry or entry['hash'] != hsh or entry['export'] != exportPath:
+    return False
+  try: return os.path.getmtime(exportPath) == entry['mtime']
+  except OSError: return False # export was removed
+
+def _exportAll(paths, jobs):
+  """Export paths, yielding (path, exportPath, seconds, error)."""
+  if jobs == 1:
+    for p, e in paths: yield (p, e, *_exportTimed(p, e))
+    return
+  # imported here since it is slow to import (it imports multiprocessing)
+  from concurrent.futures import ProcessPoolExecutor, as_completed
+  with ProcessPoolExecutor(jobs) as pool:
+    futures = {pool.submit(_exportTimed, p, e): (p, e) for p, e in paths}
+    for fut in as_completed(futures):
+      yield (*futures[fut], *fut.result())
+
+def exportDir(root, exportRoot, ext='.html', jobs=None, force=False):
+  """Export all .cxt files under root into the same tree under exportRoot.
+
+  Files are exported in parallel across a pool of jobs processes (or in this
+  process if jobs == 1). Files whose source (and cxt.py) is unchanged since
+  the last export are skipped using the manifest stored in exportRoot, unless
+  force=True.
+
+  Returns [(path, exportPath, seconds, error)] in the order the files
+  finished. Skipped files have seconds=None.
+  """
+  manifestPath = os.path.join(exportRoot, MANIFEST)
+  manifest = {} if force else loadManifest(manifestPath)
+  newManifest = {}
+  tool = toolHash()
+  out, todo, hashes = [], [], {}
+  for path, exportPath in exportPaths(root, exportRoot, ext):
+    key = os.path.relpath(path, root)
+    hsh = sourceHash(path, tool)
+    if isFresh(manifest.get(key), hsh, exportPath):
+      newManifest[key] = manifest[key]
+      out.append((path, exportPath, None, None))
+      continue
+    os.makedirs(os.path.dirname(exportPath), exist_ok=True)
+    todo.append((path, exportPath)); hashes[path] = (key, hsh)
+
+  for path, exportPath, t, err in _exportAll(todo, jobs):
+    out.append((path, exportPath, t, err))
+    if err: continue
+    key, hsh = hashes[path]
+    newManifest[key] = {
+      'hash': hsh, 'export': exportPath,
+      'mtime': os.path.getmtime(exportPath),
+    }
+  os.makedirs(exportRoot, exist_ok=True)
+  saveManifest(manifestPath, newManifest)
+  return out
+
+def mainDir(args):
+  if args.ext not in EXPORT_EXTS:
+    syserr(f"Unknown file type. Supported are: {', '.join(EXPORT_EXTS)}")
+  start = time.perf_counter()
+  results = exportDir(args.path, args.export, args.ext, args.jobs, args.force)
+  cached = failed = 0
+  for path, exportPath, t, err in results:
+    if err:        print(f"Error: {path}: {err}"); failed += 1
+    elif t is None: cached += 1
+    else:          print(f"Exported {path} to {exportPath} ({t:.3f}s)")
+  print(f"Exported {len(results) - cached - failed} files in"
+        f" {time.perf_counter() - start:.3f}s"
+        f" ({cached} unchanged, {failed} failed)")
+  if failed: sys.exit(1)
+
+def main(args):
+  if args.serve: return serve(args.serve, args.jobs)
+  if not (args.path and args.export): argP.error("path and export are required")
+  if os.path.isdir(args.path): return mainDir(args)
+  export(args.path, args.export)
   print("Exported to:", args.export)
 
 if __name__ == '__main__':
@@ -0,0 +1,130 @@
+"""Load test of the cxt render server (python3 cxt.py --serve ADDR).
+
+Concurrent clients POST a generated document (see bench.py) to /html and the
+latency percentiles and throughput are reported.
+
+Run with: python3 loadtest.py [--requests N] [--concurrency C] [--jobs J]
+
+Unless --addr is given a server is started (with --jobs workers) for the run.
+With --cli each request instead shells out to cxt.py, for comparison.
+"""
+
+import argparse
+import asyncio
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+import bench
+
+CXT = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'cxt.py')
+
+def percentile(sortedValues: list, p: float) -> float:
+  return sortedValues[min(len(sortedValues) - 1, int(p / 100 * len(sortedValues)))]
+
+async def connect(addr: str):
+  host, _, port = addr.rpartition(':')
+  if host and port.isdigit(): return await asyncio.open_connection(host, int(port))
+  return await asyncio.open_unix_connection(addr)
+
+async def post(reader, writer, body: bytes) -> int:
+  """POST body to /html, returning the status. The connection is kept alive."""
+  writer.write(b'POST /html HTTP/1.1\r\nHost: cxt\r\n'
+               b'Content-Length: %d\r\n\r\n' % len(body) + body)
+  await writer.drain()
+  head = (await reader.readuntil(b'\r\n\r\n')).decode('latin-1').split('\r\n')
+  length = next(int(l.split(':')[1]) for l in head
+                if l.lower().startswith('content-length:'))
+  await reader.readexactly(length)
+  return int(head[0].split(' ')[1])
+
+async def clientServer(addr, body, todo, latencies, errors):
+  reader, writer = await connect(addr)
+  try:
+    while todo:
+      todo.pop()
+      start = time.perf_counter()
+      status = await post(reader, writer, body)
+      latencies.append(time.perf_counter() - start)
+      if status != 200: errors.append(status)
+  finally: writer.close()
+
+async def clientCli(path, todo, latencies, errors):
+  """Render like a service shelling out to cxt.py would."""
+  while todo:
+    out = f'{path}.{len(todo)}.html'
+    todo.pop()
+    start = time.perf_counter()
+    p = await asyncio.create_subprocess_exec(
+      sys.executable, CXT, path, out, stdout=subprocess.DEVNULL)
+    if await p.wait(): errors.append(p.returncode)
+    latencies.append(time.perf_counter() - start)
+    os.remove(out)
+
+async def run(args, doc: str) -> dict:
+  todo, latencies, errors = list(range(args.requests)), [], []
+  start = time.perf_counter()
+  with tempfile.TemporaryDirectory() as d:
+    if args.cli:
+      path = os.path.join(d, 'doc.cxt')
+      with open(path, 'w') as f: f.write(doc)
+      clients = [clientCli(path, todo, latencies, errors)
+                 for _ in range(args.concurrency)]
+    else:
+      body = doc.encode('utf-8')
+      clients = [clientServer(args.addr, body, todo, latencies, errors)
+                 for _ in range(args.concurrency)]
+    await asyncio.gather(*clients)
+  seconds = time.perf_counter() - start
+  latencies.sort()
+  return {
+    'requests': len(latencies), 'errors': len(errors), 'seconds': seconds,
+    'rps': len(latencies) / seconds,
+    **{f'p{p}': percentile(latencies, p) for p in (50, 90, 99)},
+    'max': latencies[-1],
+  }
+
+def startServer(addr: str, jobs: int) -> subprocess.Popen:
+  """Start cxt.py --serve and wait until it is serving."""
+  p = subprocess.Popen([sys.executable, CXT, '--serve', addr, '-j', str(jobs)],
+                       stdout=subprocess.PIPE, text=True)
+  line = p.stdout.readline()
+  if not line.startswith('Serving'):
+    p.kill(); raise RuntimeError(f"server didn't start: {line!r}")
+  return p
+
+argP = argparse.ArgumentParser(description='cxt render server load test.')
+argP.add_argument('--addr', help="Address of a running server (HOST:PORT or"
+                  " unix socket path). By default one is started.")
+argP.add_argument('--jobs', '-j', type=int, default=os.cpu_count(),
+                  help="Workers of the started server.")
+argP.add_argument('--requests', '-n', type=int, default=500)
+argP.add_argument('--concurrency', '-c', type=int, default=16)
+argP.add_argument('--corpus', default='text', choices=list(bench.CORPORA))
+argP.add_argument('--size', type=int, default=20_000,
+                  help="Approximate size (in chars) of the document.")
+argP.add_argument('--cli', action='store_true',
+                  help="Instead shell out to cxt.py for every request.")
+
+def main(args):
+  doc = bench.CORPORA[args.corpus](args.size)
+  with tempfile.TemporaryDirectory() as d:
+    server = None
+    if not (args.cli or args.addr):
+      args.addr = os.path.join(d, 'cxt.sock')
+      server = startServer(args.addr, args.jobs)
+    try: r = asyncio.run(run(args, doc))
+    finally:
+      if server: server.terminate(); server.wait() # it stops its workers
+  mode = 'cli' if args.cli else f'server ({args.addr})'
+  print(f"## {mode}: {args.corpus} {len(doc):,} chars,"
+        f" concurrency {args.concurrency}")
+  print(f"  {r['requests']} requests ({r['errors']} errors) in"
+        f" {r['seconds']:.2f}s: {r['rps']:.1f} requests/s")
+  print('  latency ' + ' '.join(f"{p}={r[p] * 1000:.1f}ms"
+                                for p in ('p50', 'p90', 'p99', 'max')))
+
+if __name__ == '__main__':
+  main(argP.parse_args())
@@ -7,9 +7,17 @@ or licensed MIT under your discression.
 Modify this file in any way you wish. Contributions are welcome.
 """
 import io
+import mmap
+import os
+import re
+import sys
 import unittest
+import argparse
 import dataclasses
+import hashlib
+import marshal
 
+from array import array
 from collections import OrderedDict as odict
 from collections.abc import Hashable
 from enum import Enum
@@ -44,24 +52,40 @@ def reprArr(arr: list):
 
 @dataclass
 class ZoaRaw:
+  __slots__ = ('data', 'arr')
   data: bytearray
   arr: list["ZoaRaw"]
 
   @classmethod
   def frPy(cls, value):
     if isbytes(value): return cls.new_data(value)
-    out = []
-    for v in value:
-      out.append(ZoaRaw.frPy(v))
-    return cls.new_arr(out)
+    root = cls.new_arr()
+    stack = [(root.arr, iter(value))] # explicit stack: no recursion
+    while stack:
+      out, it = stack[-1]
+      for v in it:
+        if isbytes(v): out.append(ZoaRaw.new_data(v)); continue
+        z = ZoaRaw.new_arr(); out.append(z)
+        stack.append((z.arr, iter(v)))
+        break
+      else: stack.pop()
+    return root
 
   def to_py(self):
     if self.data is not None: return bytes(self.data)
     if self.arr is None: raise ValueError(self)
-    out = []
-    for v in self.arr:
-      out.append(v.to_py())
-    return out
+    root = []
+    stack = [(root, iter(self.arr))] # explicit stack: no recursion
+    while stack:
+      out, it = stack[-1]
+      for v in it:
+        if v.data is not None: out.append(bytes(v.data)); continue
+        if v.arr is None: raise ValueError(v)
+        l = []; out.append(l)
+        stack.append((l, iter(v.arr)))
+        break
+      else: stack.pop()
+    return root
 
   @classmethod
   def new_arr(cls, value=None):
@@ -72,12 +96,17 @@ class ZoaRaw:
     return cls(data=value if value is not None else bytearray(), arr=None)
 
   def serialize(self, bw=None):
-    bw = bw if bw is not None else io.BytesIO()
-    if self.data: write_data(bw, self.data)
-    else:         write_arr(bw, self.arr)
+    if bw is None: return io.BytesIO(self.encode())
+    bw.write(self.encode())
     bw.seek(0)
     return bw
 
+  def encode(self) -> bytearray:
+    """Return the zoab encoding, written in a single pass to one buffer."""
+    out = bytearray()
+    encode_raw(out, self)
+    return out
+
   def extend(self, value):
     if isbytes(value):
       if self.data is None: raise ValueError("invalid extend")
@@ -115,24 +144,88 @@ def write_data(bw: io.BytesIO, data: bytes):
   write_byte(bw, len(data) - i) # note: not joined
   bw.write(data[i:])
 
+def arr_meta(length: int, i: int) -> int:
+  """The meta byte of the arr block starting at item i."""
+  remaining = length - i
+  if remaining > 63: return ZOA_ARR | ZOA_JOIN | 63
+  return ZOA_ARR | remaining
+
 def write_arr(bw: io.BytesIO, arr: list[ZoaRaw]):
+  write_byte(bw, arr_meta(len(arr), 0))
+  stack = [] # (arr, i) of the arrays nested arr is inside of
   i = 0
   while True:
-    remaining = len(arr) - i
-    join = ZOA_JOIN if remaining > 63 else 0
-    write_byte(bw, ZOA_ARR | join | min(63, remaining))
-
-    j = 0
-    while True:
-      if i == len(arr): return
-      if j >= 63: break
-      v = arr[i]
+    while i < len(arr):
+      if i and not i % 63: write_byte(bw, arr_meta(len(arr), i))
+      v = arr[i]; i += 1
       if v.data  is not None: write_data(bw, v.data)
-      elif v.arr is not None: write_arr(bw, v.arr)
+      elif v.arr is not None:
+        stack.append((arr, i))
+        arr, i = v.arr, 0
+        write_byte(bw, arr_meta(len(arr), 0))
       else: raise ValueError(v)
+    if not stack: return
+    arr, i = stack.pop()
+
+def encode_data(out: bytearray, data: bytes):
+  """Append the zoab encoding of data to out."""
+  length = len(data)
+  if length <= 63: # also handles empty data: no join bit, arr bit, or length
+    out.append(length); out += data
+    return
 
-      j += 1
-      i += 1
+  # write the join blocks, then the last (not joined) block
+  mv = memoryview(data)
+  joined = 63 * ((length - 1) // 63)
+  for i in range(0, joined, 63):
+    out.append(ZOA_JOIN | 63); out += mv[i:i+63]
+  out.append(length - joined); out += mv[joined:]
+
+def encode_arr_items(out: bytearray, arr: list[ZoaRaw]):
+  """Append arr's first meta byte to out and return an iterator of its items.
+
+  Long arrays append the meta of each later block as it is reached.
+  """
+  if len(arr) <= 63: # common case: no join blocks
+    out.append(ZOA_ARR | len(arr))
+    return iter(arr)
+  return _encode_arr_blocks(out, arr)
+
+def _encode_arr_blocks(out: bytearray, arr: list[ZoaRaw]):
+  for i in range(0, len(arr), 63):
+    out.append(arr_meta(len(arr), i))
+    yield from arr[i:i+63]
+
+def encode_arr(out: bytearray, arr: list[ZoaRaw]):
+  """Append the zoab encoding of arr to out.
+
+  Nested arrays are encoded using an explicit stack instead of recursion.
+  """
+  stack = [] # item iterators of the arrays being encoded
+  items = encode_arr_items(out, arr)
+  while True:
+    for v in items:
+      data = v.data
+      if data is not None:
+        if len(data) <= 63: out.append(len(data)); out += data # common case
+        else:               encode_data(out, data)
+      elif v.arr is not None:
+        stack.append(items)
+        items = encode_arr_items(out, v.arr)
+        break
+      else: raise ValueError(v)
+    else:
+      if not stack: return
+      items = stack.pop()
+
+def encode_raw(out: bytearray, z: ZoaRaw):
+  """Append the zoab encoding of z to out."""
+  data = z.data
+  if data is not None:
+    if len(data) <= 63: out.append(len(data)); out += data # common case
+    else:               encode_data(out, data)
+  elif z.arr is not None: encode_arr(out, z.arr)
+  else: raise ValueError(z)
 
 def readexact(br: io.BytesIO, to: bytearray, length: int):
   while length:
@@ -143,30 +236,436 @@ def readexact(br: io.BytesIO, to: bytearray, length: int):
     if not length: break
 
 def from_zoab(br: io.BytesIO, joinTo:ZoaRaw = None):
-  out = None
-  join = 0
-
-  prev_ty = 1
+  root = None
+  stack = [] # [arr, remaining items in block, join] of arrays being read
   while True:
     meta = int_from_bytes(br.read(1))
-    ty = ZOA_ARR & meta
-    if join:
-      if ty != prev_ty: raise ValueError("join different types")
-    else:
-      if ZOA_ARR & ty:  out = ZoaRaw.new_arr()
-      else:             out = ZoaRaw.new_data()
     length = ZOA_LEN_MASK & meta
-
-    if ty: # is arr
-      for _ in range(length):
-        out.arr.append(from_zoab(br))
-    else:  # is data
-      readexact(br, out.data, length)
-
-    join = ZOA_JOIN & meta
-    if not join:
-      return out
-    prev_ty = ty
+    if ZOA_ARR & meta:
+      z = ZoaRaw.new_arr(); frame = [z.arr, length, ZOA_JOIN & meta]
+    else:
+      z = ZoaRaw.new_data(); frame = None
+      readexact(br, z.data, length)
+      while ZOA_JOIN & meta:
+        meta = int_from_bytes(br.read(1))
+        if ZOA_ARR & meta: raise ValueError("join different types")
+        readexact(br, z.data, ZOA_LEN_MASK & meta)
+
+    if stack: parent = stack[-1]; parent[0].append(z); parent[1] -= 1
+    else: root = z
+    if frame: stack.append(frame)
+
+    # finish any completed arrays, reading their join blocks
+    while stack and not stack[-1][1]:
+      frame = stack[-1]
+      if not frame[2]: stack.pop(); continue
+      meta = int_from_bytes(br.read(1))
+      if not ZOA_ARR & meta: raise ValueError("join different types")
+      frame[1] = ZOA_LEN_MASK & meta; frame[2] = ZOA_JOIN & meta
+    if not stack: return root
+
+def decode_zoab(buf, i: int = 0) -> Tuple[ZoaRaw, int]:
+  """Decode the zoab value at buf[i:], returning (value, end index).
+
+  buf can be any buffer that can be indexed and sliced (bytes, bytearray,
+  mmap, memoryview, etc). Data is returned as slices of buf: these are views
+  (no copy) when buf is a memoryview. Joined data is copied into a single
+  bytearray. Arrays are decoded using an explicit stack instead of recursion,
+  so any depth is supported.
+  """
+  end = len(buf)
+  root = None
+  stack = [] # [arr, remaining items in block, join] of arrays being decoded
+  try:
+    while True:
+      if stack: # fast path: plain data items of the current array
+        frame = stack[-1]; arr = frame[0]; remaining = frame[1]
+        while remaining and not (ZOA_ARR | ZOA_JOIN) & buf[i]:
+          j = i + 1 + buf[i]
+          if j > end: raise Eof()
+          arr.append(ZoaRaw(buf[i+1:j], None))
+          i = j; remaining -= 1
+        frame[1] = remaining
+
+      if not stack or remaining:
+        meta = buf[i]; i += 1
+        length = ZOA_LEN_MASK & meta
+        if ZOA_ARR & meta:
+          z = ZoaRaw(None, [])
+          frame = [z.arr, length, ZOA_JOIN & meta]
+        else:
+          frame = None
+          data = bytearray() # joined (or the root) data
+          while True:
+            if i + length > end: raise Eof()
+            data += buf[i:i+length]; i += length
+            if not ZOA_JOIN & meta: break
+            meta = buf[i]; i += 1
+            if ZOA_ARR & meta: raise ValueError("join different types")
+            length = ZOA_LEN_MASK & meta
+          z = ZoaRaw(data, None)
+
+        if stack:
+          parent = stack[-1]; parent[0].append(z); parent[1] -= 1
+        else: root = z
+        if frame: stack.append(frame)
+
+      # finish any completed arrays, reading their join blocks
+      while stack and not stack[-1][1]:
+        frame = stack[-1]
+        if not frame[2]: stack.pop(); continue
+        meta = buf[i]; i += 1
+        if not ZOA_ARR & meta: raise ValueError("join different types")
+        frame[1] = ZOA_LEN_MASK & meta; frame[2] = ZOA_JOIN & meta
+      if not stack: return root, i
+  except IndexError: raise Eof()
+
+def decode_data(buf, i: int = 0) -> Tuple[Any, int]:
+  """Decode the data at buf[i:], returning (data, end index).
+
+  Data which isn't joined is a slice of buf (see decode_zoab). Joined data is
+  copied into a bytearray: runs of full blocks (as encode_data writes them)
+  are copied at once, deleting their meta bytes with a strided del.
+  """
+  full = ZOA_JOIN | ZOA_LEN_MASK # the meta of a full join block
+  end, data, run = len(buf), None, 4 # run: full blocks to look for at once
+  try:
+    meta = buf[i]
+    while ZOA_JOIN & meta:
+      if ZOA_ARR & meta: raise ValueError(f"expected data at {i}")
+      if data is None: data = bytearray()
+      if meta == full:
+        metas = bytes(buf[i:i + 64 * run:64])
+        n = len(metas) - len(metas.lstrip(bytes((full,))))
+        if i + 64 * n > end: raise Eof()
+        blocks = bytearray(buf[i:i + 64 * n]); del blocks[::64]
+        data += blocks; i += 64 * n; run *= 2
+      else:
+        j = i + 1 + (ZOA_LEN_MASK & meta)
+        if j > end: raise Eof()
+        data += buf[i+1:j]; i = j
+      meta = buf[i]
+    if ZOA_ARR & meta: raise ValueError(f"expected data at {i}")
+    j = i + 1 + meta
+    if j > end: raise Eof()
+    if data is None: return buf[i+1:j], j
+    data += buf[i+1:j]
+    return data, j
+  except IndexError: raise Eof()
+
+def mmap_zoab(path) -> ZoaRaw:
+  """Decode the zoab file at path, mapping it instead of reading it.
+
+  The data of the returned value are memoryviews of the map (not copies).
+  """
+  with open(path, 'rb') as f:
+    m = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+  return decode_zoab(memoryview(m))[0]
+
+class ZoaEvent(Enum):
+  DATA      = 0 # a data value
+  ARR_START = 1 # the start of an array
+  ARR_END   = 2 # the end of an array
+
+class ZoabReader:
+  """Read a stream of zoab values incrementally.
+
+  Iterating yields each top-level value as a ZoaRaw as soon as it has been
+  read. events() instead yields (ZoaEvent, data) for every value as it is
+  read, where data is only set for DATA. skip() skips values without
+  decoding them (seeking over their data if br is seekable).
+
+  Only the data being read and the stack of open arrays are kept in memory.
+  """
+  def __init__(self, br):
+    self.br = br
+    self.seekable = getattr(br, 'seekable', lambda: False)()
+    self.stack = [] # [remaining items in block, join] of the open arrays
+
+  def __iter__(self):
+    while True:
+      z = self.read()
+      if z is None: return
+      yield z
+
+  def read(self) -> ZoaRaw:
+    """Read the next value.
+
+    Returns None at the end of the stream or, if called between events, at
+    the end of the innermost open array.
+    """
+    root, arrs = None, []
+    for event, data in self.events():
+      if event is ZoaEvent.ARR_END:
+        if not arrs: return None # end of the array read was called inside
+        arrs.pop()
+        if not arrs: return root
+        continue
+      z = ZoaRaw.new_data(data) if data is not None else ZoaRaw.new_arr()
+      if arrs: arrs[-1].arr.append(z)
+      else:    root = z
+      if event is ZoaEvent.ARR_START: arrs.append(z)
+      elif not arrs: return root
+    return None
+
+  def events(self):
+    """Yield (ZoaEvent, data) of the values read until the end of the stream.
+
+    skip() can be called between events.
+    """
+    stack = self.stack
+    while True:
+      while stack and not stack[-1][0]: # completed array
+        if stack[-1][1]: self._joinArr(); continue
+        stack.pop()
+        yield ZoaEvent.ARR_END, None
+      meta = self._meta(eof=not stack)
+      if meta is None: return
+      if stack: stack[-1][0] -= 1
+      if ZOA_ARR & meta:
+        stack.append([ZOA_LEN_MASK & meta, ZOA_JOIN & meta])
+        yield ZoaEvent.ARR_START, None
+      else: yield ZoaEvent.DATA, self._data(meta)
+
+  def skip(self) -> bool:
+    """Skip the rest of the innermost open array (including its end).
+
+    If no array is open then skip the next top-level value instead.
+    Returns False if at the end of the stream.
+    """
+    stack = self.stack
+    depth = len(stack)
+    if not depth:
+      meta = self._meta(eof=True)
+      if meta is None: return False
+      if not ZOA_ARR & meta: self._data(meta, skip=True); return True
+      stack.append([ZOA_LEN_MASK & meta, ZOA_JOIN & meta])
+      depth = 1
+    while len(stack) >= depth:
+      frame = stack[-1]
+      if not frame[0]:
+        if frame[1]: self._joinArr()
+        else:        stack.pop()
+        continue
+      meta = self._meta(); frame[0] -= 1
+      if ZOA_ARR & meta: stack.append([ZOA_LEN_MASK & meta, ZOA_JOIN & meta])
+      else:              self._data(meta, skip=True)
+    return True
+
+  def _meta(self, eof=False) -> int:
+    """Read a meta byte. If eof then return None at the end of the stream."""
+    b = self.br.read(1)
+    if b: return b[0]
+    if eof: return None
+    raise Eof()
+
+  def _data(self, meta: int, skip=False) -> bytearray:
+    data = None if skip else bytearray()
+    while True:
+      length = ZOA_LEN_MASK & meta
+      if data is not None: readexact(self.br, data, length)
+      elif self.seekable:  self.br.seek(length, io.SEEK_CUR)
+      else:                readexact(self.br, bytearray(), length)
+      if not ZOA_JOIN & meta: return data
+      meta = self._meta()
+      if ZOA_ARR & meta: raise ValueError("join different types")
+
+  def _joinArr(self):
+    meta = self._meta()
+    if not ZOA_ARR & meta: raise ValueError("join different types")
+    self.stack[-1][:] = (ZOA_LEN_MASK & meta, ZOA_JOIN & meta)
+
+def skip_zoab(buf, i: int = 0) -> int:
+  """Return the end index of the zoab value at buf[i:] without decoding it."""
+  pending = 1 # values (and join blocks) left to skip
+  try:
+    while pending:
+      meta = buf[i]; i += 1; pending -= 1
+      if ZOA_JOIN & meta: pending += 1
+      if ZOA_ARR & meta:  pending += ZOA_LEN_MASK & meta
+      else:               i += ZOA_LEN_MASK & meta
+  except IndexError: raise Eof()
+  if i > len(buf): raise Eof()
+  return i
+
+def arr_spans(buf, i: int, spans: array, itemEnd=skip_zoab) -> int:
+  """Append the (start, end) of each item of the arr at buf[i:] to spans.
+
+  itemEnd(buf, start) returns the end of an item. Returns the end of the arr.
+  """
+  while True:
+    if i >= len(buf): raise Eof()
+    meta = buf[i]; i += 1
+    if not ZOA_ARR & meta: raise ValueError("expected arr")
+    for _ in range(ZOA_LEN_MASK & meta):
+      start = i; i = itemEnd(buf, i)
+      spans.append(start); spans.append(i)
+    if not ZOA_JOIN & meta: return i
+
+def index_zoab(buf, depth=1) -> Tuple[array, array, array]:
+  """Index the items of the root arr of buf without decoding them.
+
+  Returns (spans, childStarts, childSpans). spans has the (start, end) of
+  each item. If depth=2 then childSpans also has the (start, end) of the
+  items of each arr item, which for item i are the pairs
+  childStarts[i]:childStarts[i+1].
+  """
+  spans, childStarts, childSpans = array('Q'), array('Q', [0]), array('Q')
+  def itemEnd(buf, i):
+    if i < len(buf) and ZOA_ARR & buf[i]: i = arr_spans(buf, i, childSpans)
+    else:                                 i = skip_zoab(buf, i)
+    childStarts.append(len(childSpans) // 2)
+    return i
+  arr_spans(buf, 0, spans, itemEnd if depth > 1 else skip_zoab)
+  if depth <= 1: childStarts = array('Q')
+  return spans, childStarts, childSpans
+
+ZIDX_EXT = '.zidx'
+ZIDX_MAGIC = b'ZIDX'
+ZIDX_VERSION = 1
+# magic, byteorder, depth, version, pad byte then u64: data size, data mtime_ns,
+# data sample hash, items, child items
+ZIDX_HEADER = 48
+ZIDX_SAMPLE = 4096
+
+def index_path(path: str) -> str: return path + ZIDX_EXT
+
+def _zidx_stamp(f, m) -> list:
+  """Return [size, mtime_ns, hash] of the data file f (mapped as m).
+
+  The hash is of the first and last ZIDX_SAMPLE bytes, to detect a rewrite
+  with the same size which kept (or restored) the mtime.
+  """
+  h = hashlib.blake2b(m[:ZIDX_SAMPLE], digest_size=8)
+  h.update(m[-ZIDX_SAMPLE:])
+  return [len(m), os.fstat(f.fileno()).st_mtime_ns,
+          int.from_bytes(h.digest(), 'little')]
+
+def write_zoab_index(path: str, depth=1, indexPath=None) -> str:
+  """Write the sidecar index of the zoab file at path, returning its path.
+
+  The index is a header followed by the u64 arrays of index_zoab (in native
+  byte order) so that it can be mapped and used without parsing it.
+  """
+  indexPath = indexPath or index_path(path)
+  depth = 2 if depth > 1 else 1
+  with open(path, 'rb') as f:
+    with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+      stamp = _zidx_stamp(f, m)
+      spans, childStarts, childSpans = index_zoab(m, depth)
+  header = (ZIDX_MAGIC + sys.byteorder[0].encode()
+    + bytes([depth, ZIDX_VERSION, 0])
+    + array('Q', stamp + [len(spans) // 2, len(childSpans) // 2]).tobytes())
+  assert len(header) == ZIDX_HEADER
+  tmp = indexPath + '.tmp'
+  with open(tmp, 'wb') as f:
+    f.write(header)
+    for a in (spans, childStarts, childSpans): a.tofile(f)
+  os.replace(tmp, indexPath)
+  return indexPath
+
+class ZoabFile:
+  """Random access to the items of the root arr of a zoab file.
+
+  Uses the sidecar index (see write_zoab_index) and mmap so that getting an
+  item only decodes that item.
+  """
+  def __init__(self, path: str, indexPath=None):
+    indexPath = indexPath or index_path(path)
+    with open(path, 'rb') as f:
+      self._dataMap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+      stamp = _zidx_stamp(f, self._dataMap)
+    with open(indexPath, 'rb') as f:
+      self._indexMap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    header = self._indexMap[:ZIDX_HEADER]
+    if header[:4] != ZIDX_MAGIC:
+      raise ValueError(f"not a zoab index: {indexPath}")
+    if header[4:5] != sys.byteorder[0].encode():
+      raise ValueError(f"index has a different byte order: {indexPath}")
+    self.depth = header[5]
+    if header[6] != ZIDX_VERSION:
+      raise ValueError(f"index has a different version: {indexPath}")
+    q = array('Q', header[8:]).tolist()
+    if q[:3] != stamp: raise ValueError(f"stale index: {indexPath}")
+    length, childLength = q[3:]
+
+    q = memoryview(self._indexMap)[ZIDX_HEADER:].cast('Q')
+    self.length = length
+    self.spans = q[:2 * length]
+    starts = 2 * length + (length + 1 if self.depth > 1 else 0)
+    self.childStarts = q[2 * length:starts]
+    self.childSpans = q[starts:starts + 2 * childLength]
+    q.release()
+
+  def __len__(self): return self.length
+
+  def __getitem__(self, i: int) -> ZoaRaw:
+    if i < 0: i += self.length
+    if not 0 <= i < self.length: raise IndexError(i)
+    return self._decode(self.spans, i)
+
+  def item(self, i: int, j: int) -> ZoaRaw:
+    """Get item j of item i (requires a depth=2 index)."""
+    if self.depth < 2: raise ValueError("index depth < 2")
+    if i < 0: i += self.length
+    if not 0 <= i < self.length: raise IndexError(i)
+    start, end = self.childStarts[i], self.childStarts[i + 1]
+    if j < 0: j += end - start
+    if not 0 <= j < end - start: raise IndexError(j)
+    return self._decode(self.childSpans, start + j)
+
+  def _decode(self, spans, i: int) -> ZoaRaw:
+    # slicing the map copies the item, so the result doesn't reference it
+    return decode_zoab(self._dataMap[spans[2 * i]:spans[2 * i + 1]])[0]
+
+  def close(self):
+    for v in (self.spans, self.childStarts, self.childSpans): v.release()
+    self._dataMap.close(); self._indexMap.close()
+
+  def __enter__(self): return self
+  def __exit__(self, *_exc): self.close()
+
+def runToZ(value) -> ZoaRaw:
+  """Return value.toZ() using an explicit stack instead of recursion.
+
+  Types which contain other values implement _toZ as a generator: it yields
+  each child value and is sent back the child's ZoaRaw.
+  """
+  return runToZGen(value._toZ())
+
+def runToZGen(gen) -> ZoaRaw:
+  """Run a _toZ generator, see runToZ."""
+  stack = [gen]; z = None
+  while True:
+    try: child = stack[-1].send(z)
+    except StopIteration as e:
+      stack.pop()
+      if not stack: return e.value
+      z = e.value; continue
+    toZ = getattr(child, '_toZ', None)
+    if toZ is None: z = child.toZ()
+    else:           stack.append(toZ()); z = None
+
+def runFrZ(ty, z: ZoaRaw):
+  """Return ty.frZ(z) using an explicit stack instead of recursion.
+
+  Types which contain other values implement _frZ as a generator: it yields
+  (ty, z) of each child and is sent back the child's value.
+  """
+  return runFrZGen(ty._frZ(z))
+
+def runFrZGen(gen):
+  """Run a _frZ generator, see runFrZ."""
+  stack = [gen]; v = None
+  while True:
+    try: ty, z = stack[-1].send(v)
+    except StopIteration as e:
+      stack.pop()
+      if not stack: return e.value
+      v = e.value; continue
+    frZ = getattr(ty, '_frZ', None)
+    if frZ is None: v = ty.frZ(z)
+    else:           stack.append(frZ(z)); v = None
 
 @dataclass
 class Undefined:
@@ -192,6 +691,8 @@ class Int(int):
   @classmethod
   def frPy(cls, *args, **kwargs): return cls(*args, **kwargs)
 
+  _toZ = _frZ = None # not nested, see runToZ/runFrZ
+
   @classmethod
   def frZ(cls, raw: ZoaRaw) -> int:
     if raw.arr:
@@ -213,6 +714,7 @@ class Data(bytes):
 
   @classmethod
   def frPy(cls, *args, **kwargs): return cls(*args, **kwargs)
+  _toZ = _frZ = None
   @classmethod
   def frZ(cls, raw: ZoaRaw) -> "Data": return cls(raw.data)
   def toZ(self) -> ZoaRaw: return ZoaRaw.new_data(self)
@@ -224,8 +726,9 @@ class Str(str):
 
   @classmethod
   def frPy(cls, *args, **kwargs): return cls(*args, **kwargs)
+  _toZ = _frZ = None
   @classmethod
-  def frZ(cls, raw: ZoaRaw) -> "Str": return cls(raw.data.decode('utf-8'))
+  def frZ(cls, raw: ZoaRaw) -> "Str": return cls(str(raw.data, 'utf-8'))
   def toZ(self) -> ZoaRaw: return ZoaRaw.new_data(self.encode('utf-8'))
   def toPy(self) -> 'Str': return self
 
@@ -233,11 +736,27 @@ class ArrBase(list):
   @classmethod
   def frPy(cls, l: Iterable[Any]): return cls([cls._ty.frPy(i) for i in l])
   @classmethod
-  def frZ(cls, raw: ZoaRaw): return cls(cls._ty.frZ(z) for z in raw.arr)
-  def toZ(self) -> ZoaRaw: return ZoaRaw.new_arr([v.toZ() for v in self])
+  def frZ(cls, raw: ZoaRaw): return runFrZ(cls, raw)
+  def toZ(self) -> ZoaRaw: return runToZ(self)
   def toPy(self) -> list: return [v.toPy() for v in self]
   def __repr__(self): return reprArr(self)
 
+  @classmethod
+  def _frZ(cls, raw: ZoaRaw):
+    ty = cls._ty
+    if getattr(ty, '_frZ', True) is None: # not nested: decode directly
+      frZ = ty.frZ
+      return cls([frZ(z) for z in raw.arr])
+    out = []
+    for z in raw.arr: out.append((yield ty, z))
+    return cls(out)
+
+  def _toZ(self):
+    out = []
+    for v in self:
+      out.append(v.toZ() if getattr(v, '_toZ', True) is None else (yield v))
+    return ZoaRaw.new_arr(out)
+
   @classmethod
   def _define(cls, name, ty):
     cls._ty = updateUndefined(cls._ty, name, ty)
@@ -253,26 +772,32 @@ class MapBase(odict):
     return cls(odict((cls._kty.frPy(k), cls._vty.frPy(v)) for k, v in l))
 
   @classmethod
-  def frZ(cls, raw: ZoaRaw):
-    if len(raw.arr) % 2 != 0: raise ValueError(f"length not even: {raw}")
-    arr = iter(raw.arr)
-    out = odict()
-    while True:
-      try:
-        key = cls._kty.frZ(next(arr))
-        out[key] = cls._vty.frZ(next(arr))
-      except StopIteration: break
-    return cls(out)
-
-  def toZ(self) -> ZoaRaw:
-    def flatten():
-      for key, value in self.items():
-        yield key.toZ(); yield value.toZ()
-    return ZoaRaw.new_arr(list(flatten()))
+  def frZ(cls, raw: ZoaRaw): return runFrZ(cls, raw)
+  def toZ(self) -> ZoaRaw: return runToZ(self)
 
   def toPy(self) -> odict: return odict((k.toPy(), v.toPy()) for k, v in self.items())
   def __repr__(self): return repr(self.toPy())
 
+  @classmethod
+  def _frZ(cls, raw: ZoaRaw):
+    arr, kty, vty = raw.arr, cls._kty, cls._vty
+    if len(arr) % 2 != 0: raise ValueError(f"length not even: {raw}")
+    if getattr(kty, '_frZ', True) is None and getattr(vty, '_frZ', True) is None:
+      kfrZ, vfrZ = kty.frZ, vty.frZ # not nested: decode directly
+      return cls((kfrZ(arr[i]), vfrZ(arr[i + 1])) for i in range(0, len(arr), 2))
+    out = cls()
+    for i in range(0, len(arr), 2):
+      key = yield kty, arr[i]
+      out[key] = yield vty, arr[i + 1]
+    return out
+
+  def _toZ(self):
+    out = []
+    for kv in self.items():
+      for v in kv:
+        out.append(v.toZ() if getattr(v, '_toZ', True) is None else (yield v))
+    return ZoaRaw.new_arr(out)
+
   @classmethod
   def _define(cls, name, ty):
     cls._vty = updateUndefined(cls._vty, name, ty)
@@ -288,36 +813,63 @@ class StructField:
 
 @dataclass(init=False)
 class StructBase:
+  __slots__ = () # allow subclasses to use __slots__
+
   @classmethod
-  def frZ(cls, z: ZoaRaw):
+  def frZ(cls, z: ZoaRaw): return runFrZ(cls, z)
+  def toZ(self) -> ZoaRaw: return runToZ(self)
+
+  @classmethod
+  def _plan(cls):
+    """Compute the field tables used by toZ/frZ from cls._fields.
+
+    Fields are (attr, ty, frZ) where frZ is ty.frZ if ty is not nested (so
+    can be called directly) else None. Called again when an Undefined field
+    type is defined.
+    """
+    cls._posFields, cls._byId, cls._zFields = [], {}, []
+    for name, f in cls._fields.items():
+      attr = name.decode('utf-8')
+      frZ = f.ty.frZ if getattr(f.ty, '_frZ', True) is None else None
+      if f.zid is None: cls._posFields.append((attr, f.ty, frZ))
+      else:             cls._byId[f.zid] = (attr, f.ty, frZ)
+      zid = None if f.zid is None else Int(f.zid).toZ().data
+      cls._zFields.append((attr, zid, getattr(f.ty, '_toZ', True) is None))
+
+  @classmethod
+  def _frZ(cls, z: ZoaRaw):
+    arr, posFields = z.arr, cls._posFields
+    posArgs = Int.frZ(arr[0]) # number of positional args
+    if posArgs > len(posFields): raise ValueError(
+      f"{cls.name} has {len(posFields)} positional fields, got {posArgs}")
     args = []
-    posArgs = Int.frZ(z.arr[0]) # number of positional args
-    fields = iter(cls._fields.items())
-    for pos in range(posArgs):
-      _name, f = next(fields)
-      assert f.zid is None
-      args.append(f.ty.frZ(z.arr[1 + pos]))
+    for i in range(posArgs):
+      _attr, ty, frZ = posFields[i]
+      args.append(frZ(arr[1 + i]) if frZ else (yield ty, arr[1 + i]))
+    args.extend(None for _ in range(len(posFields) - posArgs))
+    if len(arr) == 1 + posArgs: return cls(*args)
     kwargs = {}
-    byId = {f.zid: (name, f.ty) for name, f in cls._fields.items()}
-    for z in z.arr[1+posArgs:]:
-      name, ty = byId[Int.frZ(zi[0])]
-      kwargs[name] = ty.frZ(zi[1])
+    for zi in arr[1 + posArgs:]:
+      attr, ty, frZ = cls._byId[Int.frZ(zi.arr[0])]
+      kwargs[attr] = frZ(zi.arr[1]) if frZ else (yield ty, zi.arr[1])
     return cls(*args, **kwargs)
 
-  def toZ(self) -> ZoaRaw:
+  def _toZ(self):
     # find how many positional args exist
     posArgs = 0; posArgsDone = False
-    for name, f in self._fields.items():
-      if f.zid is None: # positional arg
-        if getattr(self, name.decode('utf-8')) is None: posArgsDone = True
-        elif posArgsDone: raise ValueError(
-          f"{name} has value after previous positional arg wasn't specified")
-        else: posArgs += 1
+    for attr, _ty, _frZ in self._posFields:
+      if getattr(self, attr) is None: posArgsDone = True
+      elif posArgsDone: raise ValueError(
+        f"{attr} has value after previous positional arg wasn't specified")
+      else: posArgs += 1
 
     out = [Int(posArgs).toZ()] # starts with number of positional arguments
-    for name, f in self._fields.items():
-      if f.zid is None: out.append(getattr(self, name.decode('utf-8')).toZ())
-      else: out.append(ZoaRaw.new_arr([f.zid, self.get(name).toZ()]))
+    for attr, zid, leaf in self._zFields:
+      v = getattr(self, attr)
+      if v is None: continue
+      vz = v.toZ() if leaf else (yield v)
+      if zid is None: out.append(vz)
+      else:           out.append(ZoaRaw.new_arr([ZoaRaw.new_data(zid), vz]))
     return ZoaRaw.new_arr(out)
 
   def toPy(self) -> dict:
@@ -331,6 +883,7 @@ class StructBase:
   def _define(cls, name, ty):
     for f in cls._fields.values():
       f._define(name, ty)
+    cls._plan()
 
 @dataclass
 class EnumVar:
@@ -342,22 +895,38 @@ class EnumVar:
 @dataclass(init=False)
 class EnumBase:
   @classmethod
-  def frZ(cls, z: ZoaRaw) -> 'EnumBase':
+  def frZ(cls, z: ZoaRaw) -> 'EnumBase': return runFrZ(cls, z)
+  def toZ(self) -> ZoaRaw: return runToZ(self)
+
+  def __post_init__(self):
+    """Track the variant which is set (not None), so toZ doesn't search."""
+    self._var = None
+    for i, attr in enumerate(self._attrs):
+      if getattr(self, attr) is None: continue
+      if self._var is not None: raise ValueError(
+        f"Multiple variants set: {self._attrs[self._var]} and {attr}")
+      self._var = i
+
+  def _variant(self) -> int:
+    """Return the index of the variant which is set."""
+    var = self._var
+    if var is None or getattr(self, self._attrs[var]) is None:
+      self.__post_init__() # the variant was changed after construction
+      var = self._var
+      if var is None: raise ValueError("No variant set")
+    return var
+
+  @classmethod
+  def _frZ(cls, z: ZoaRaw):
     variant = Int.frZ(z.arr[0])
-    name, var = cls._variants[variant]
-    return cls(**{name.decode('utf-8'): var.ty.frZ(z.arr[1])})
+    _name, var = cls._variants[variant]
+    return cls(**{cls._attrs[variant]: (yield var.ty, z.arr[1])})
 
-  def toZ(self) -> ZoaRaw:
-    variant, value = None, None
-    for i, (n, v) in enumerate(self._variants):
-      ty = v.ty
-      v = getattr(self, n.decode('utf-8'))
-      if v:
-        if variant is not None: raise ValueError(
-          f"Multiple variants set: {self._variants[variant]} and {(n, ty)}")
-        variant, value = i, v
-    if variant is None: raise ValueError("No variant set")
-    return ZoaRaw.new_arr([Int(variant).toZ(), value.toZ()])
+  def _toZ(self):
+    var = self._variant()
+    value = getattr(self, self._attrs[var])
+    vz = value.toZ() if getattr(value, '_toZ', True) is None else (yield value)
+    return ZoaRaw.new_arr([Int(var).toZ(), vz])
 
   def toPy(self) -> Enum: return self
 
@@ -400,15 +969,112 @@ class BmVar: # Bitmap Variant
       return varSelf.msk & bitmapSelf.value == varSelf.var
     return closure
 
-@dataclass
+  # Closures for BitmapCol, which operate on all of its values at once.
+  def _getColClosure(varSelf):
+    def closure(col) -> array:
+      msk = varSelf.msk
+      return array(col.values.typecode, [msk & v for v in col.values])
+    return closure
+
+  def _setColClosure(varSelf):
+    def closure(col, mask=None, var=None):
+      if var is None: var = varSelf.var
+      if var != 0 and var != varSelf.msk & var:
+        raise ValueError(
+          f'Attempt to set invalid. var={hex(var)} msk={hex(varSelf.msk)}')
+      values, keep = col.values, ~varSelf.msk
+      if mask is None: new = [(keep & v) | var for v in values]
+      else:
+        if len(mask) != len(values): raise ValueError(
+          f"mask length {len(mask)} != {len(values)}")
+        new = [(keep & v) | var if m else v for v, m in zip(values, mask)]
+      values[:] = array(values.typecode, new) # in place: keeps buffer views
+    return closure
+
+  def _isColClosure(varSelf):
+    def closure(col) -> List[bool]:
+      msk, var = varSelf.msk, varSelf.var
+      return [msk & v == var for v in col.values]
+    return closure
+
+@dataclass(slots=True) # subclasses may use __slots__
 class BitmapBase:
   value: int = 0
 
+  _interned = {} # value -> the frozen instance, each subclass has its own
+  _Frozen = None # the frozen subclass
+
+  def __init_subclass__(cls, frozen=False, **kw):
+    super(BitmapBase, cls).__init_subclass__(**kw) # not the pre-slots class
+    if frozen: return
+    cls._interned, cls._Frozen = {}, _frozenBitmap(cls)
+
   @classmethod
-  def frZ(cls, z: ZoaRaw) -> 'BitmapBase': return cls(int(Int.frZ(z)))
+  def intern(cls, value: int) -> 'BitmapBase':
+    """Return the shared instance for value.
+
+    Interned instances are of a frozen subclass: setting value (i.e. with set_*
+    or tog_*) raises TypeError. They equal the mutable instances of the same
+    value.
+    """
+    v = cls._interned.get(value)
+    if v is None: v = cls._interned[value] = cls._Frozen(value)
+    return v
+
+  def __eq__(self, o):
+    if not isinstance(o, BitmapBase) or self._Frozen is not o._Frozen:
+      return NotImplemented
+    return self.value == o.value
+
+  _toZ = _frZ = None
+  @classmethod
+  def frZ(cls, z: ZoaRaw) -> 'BitmapBase':
+    if z.data is None: return cls(int(Int.frZ(z)))
+    return cls(int.from_bytes(z.data, 'big'))
   def toZ(self) -> ZoaRaw: return Int(self.value).toZ()
   def toPy(self) -> 'BitmapBase': return self
 
+def _frozenBitmap(ty):
+  """Create the subclass of bitmap ty used by ty.intern."""
+  def __init__(self, value: int = 0): object.__setattr__(self, 'value', value)
+  def __setattr__(self, name, value):
+    raise TypeError(f"Attempted to modify interned {self}")
+  def __reduce__(self): return (ty.intern, (self.value,))
+  return type(ty.__name__, (ty,), {
+    '__qualname__': ty.__qualname__, '__module__': ty.__module__,
+    '__slots__': (), '__init__': __init__, '__setattr__': __setattr__,
+    '__delattr__': __setattr__, '__reduce__': __reduce__,
+  }, frozen=True)
+
+BitmapBase._Frozen = _frozenBitmap(BitmapBase)
+
+class BitmapCol:
+  """A column of bitmap values stored in an array (see TyEnv.bitmap).
+
+  get_/set_/is_ of each variant operate on all values at once: is_ returns a
+  list of bools, which set_ accepts as a mask. The array supports the buffer
+  protocol, i.e. numpy.frombuffer(col.values, numpy.uint32) is a view.
+  """
+  __slots__ = ('values',)
+
+  def __init__(self, values: Iterable[int] = ()):
+    self.values = array(self._typecode, values)
+
+  @classmethod
+  def frBitmaps(cls, bitmaps: Iterable[BitmapBase]) -> 'BitmapCol':
+    return cls(b.value for b in bitmaps)
+
+  def toBitmaps(self, intern=False) -> List[BitmapBase]:
+    new = self._ty.intern if intern else self._ty
+    return [new(v) for v in self.values]
+
+  def __len__(self): return len(self.values)
+  def __getitem__(self, i: int) -> BitmapBase: return self._ty(self.values[i])
+  def __setitem__(self, i: int, b: BitmapBase): self.values[i] = b.value
+  def __iter__(self): return iter(self.toBitmaps())
+  def __eq__(self, o): return type(self) is type(o) and self.values == o.values
+  def __repr__(self): return f'{self.name}({self.values.tolist()})'
+
 
 class DynType(Enum):
   Empty = 0
@@ -427,13 +1093,13 @@ class DynType(Enum):
   MapData   = 0x42
   MapStrStr = 0x43
 
-dynFrZMethod = {
-  DynType.Str: Str.frZ,
-  DynType.Data: Data.frZ,
-  DynType.Int: Int.frZ,
-  DynType.ArrStr: ArrStr.frZ,
-  DynType.ArrData: ArrData.frZ,
-  DynType.ArrInt: ArrInt.frZ,
+dynTys = {
+  DynType.Str: Str,
+  DynType.Data: Data,
+  DynType.Int: Int,
+  DynType.ArrStr: ArrStr,
+  DynType.ArrData: ArrData,
+  DynType.ArrInt: ArrInt,
 }
 
 @dataclass
@@ -473,16 +1139,20 @@ class Dyn:
   def frPyArrDyn(cls, arr): return _frPyArrDyn(cls, arr)
 
   @classmethod
-  def frZ(cls, raw: ZoaRaw) -> 'Dyn':
+  def frZ(cls, raw: ZoaRaw) -> 'Dyn': return runFrZ(cls, raw)
+  def toZ(self) -> ZoaRaw: return runToZ(self)
+
+  @classmethod
+  def _frZ(cls, raw: ZoaRaw):
     if not len(raw.arr): return cls._none()
     if len(raw.arr) != 2: raise TypeError(raw)
     ty = DynType(Int.frZ(raw.arr[0]))
-    return cls(value=dynFrZMethod[ty](raw.arr[1]), ty=ty)
+    return cls(value=(yield dynTys[ty], raw.arr[1]), ty=ty)
 
-  def toZ(self) -> ZoaRaw:
+  def _toZ(self):
     return ZoaRaw.new_arr([
       Int(self.ty.value).toZ(),
-      self.value.toZ(),
+      (yield self.value),
     ])
 
   def toPy(self) -> Any: return self.value.toPy()
@@ -491,21 +1161,190 @@ class Dyn:
 
 # Regster final dyn conversion
 ArrDyn   = type('ArrDyn', (ArrBase,),  {'_ty': Dyn,  'name': 'ArrDyn'})
-dynFrZMethod[DynType.ArrDyn] = ArrDyn.frZ
+dynTys[DynType.ArrDyn] = ArrDyn
 
 MapStrDyn  = type('MapStrDyn', (MapBase,),  {'_vty': Str, '_kty': Dyn, 'name': 'MapStrDyn'})
 MapDataDyn = type('MapDataDyn', (MapBase,), {'_vty': Data,'_kty': Dyn, 'name': 'MapDataDyn'})
 MapStrStr  = type('MapStrStr', (MapBase,),  {'_vty': Str, '_kty': Str, 'name': 'MapStrStr'})
-dynFrZMethod[DynType.MapStr] = MapStrDyn.frZ
-dynFrZMethod[DynType.MapData] = MapDataDyn.frZ
-dynFrZMethod[DynType.MapStrStr] = MapStrStr.frZ
+dynTys[DynType.MapStr] = MapStrDyn
+dynTys[DynType.MapData] = MapDataDyn
+dynTys[DynType.MapStrStr] = MapStrStr
 
 def _frPyArrDyn(cls, arr): return cls._arrDyn(ArrDyn.frPy(arr))
 
 def modname(mod, name): return mod + '.' + name if mod else name
 
-class TyEnv:
+####################
+# Compiled toZ/frZ
+#
+# TyEnv.compile() generates (and execs) source for the toZ/frZ of each
+# Arr, Map, Struct and Enum type which inlines field access and the calls
+# to its children.
+#
+# A type is "flat" if no type reachable from it is recursive, so its values
+# can only nest as deep as its type. Flat types are compiled to direct
+# functions (and become leaves for runToZ/runFrZ). Recursive types are
+# compiled to _toZ/_frZ generators, which decode their flat children
+# directly.
+
+def isLeaf(ty) -> bool: return getattr(ty, '_frZ', True) is None
+
+def tyChildren(ty) -> list:
+  """Return the types ty contains, or None if ty can't be compiled."""
+  if isinstance(ty, Undefined):
+    raise ValueError(f"compile with undefined type: {ty.name}")
+  if not isinstance(ty, type): return None
+  if issubclass(ty, ArrBase):    return [ty._ty]
+  if issubclass(ty, MapBase):    return [ty._kty, ty._vty]
+  if issubclass(ty, StructBase): return [f.ty for f in ty._fields.values()]
+  if issubclass(ty, EnumBase):   return [v.ty for _n, v in ty._variants]
+  return None
+
+class Codegen:
+  """Compile the toZ/frZ of types, see TyEnv.compile."""
   def __init__(self):
+    self.owned = set() # types whose methods are replaced
+    self.flat = {}     # ty -> is flat
+    self.codecs = {}   # ty -> (frZ, toZ): direct functions for flat types
+    self.done = set()  # compiled types
+
+  def isFlat(self, ty, visiting=None) -> bool:
+    if isLeaf(ty): return True
+    flat = self.flat.get(ty)
+    if flat is not None: return flat
+    children = tyChildren(ty)
+    if children is None: return False # opaque, i.e. Dyn
+    visiting = visiting or set()
+    if ty in visiting: return False   # recursive
+    visiting.add(ty)
+    flat = all(self.isFlat(c, visiting) for c in children)
+    visiting.discard(ty)
+    self.flat[ty] = flat
+    return flat
+
+  def compile(self, ty):
+    """Compile ty (after its children). If owned then set its methods."""
+    if ty in self.done or tyChildren(ty) is None: return
+    self.done.add(ty)
+    for c in tyChildren(ty): self.compile(c)
+    flat = self.isFlat(ty)
+    ns = {'ty': ty, 'ZoaRaw': ZoaRaw, 'IntFrZ': Int.frZ,
+          'runFrZGen': runFrZGen, 'runToZGen': runToZGen}
+    if   issubclass(ty, ArrBase):    src = self.arrSrc(ns, ty, flat)
+    elif issubclass(ty, MapBase):    src = self.mapSrc(ns, ty, flat)
+    elif issubclass(ty, StructBase): src = self.structSrc(ns, ty, flat)
+    else:                            src = self.enumSrc(ns, ty, flat)
+    exec(compile(src, f'<zoa compiled {ty.name}>', 'exec'), ns)
+    frZ, toZ = ns['frZ'], ns['toZ']
+    if flat: self.codecs[ty] = (frZ, toZ)
+    if ty not in self.owned: return
+    ty._zsrc = src # for debugging
+    if flat:
+      ty.frZ, ty._frZ = staticmethod(frZ), None
+      ty.toZ, ty._toZ = toZ, None
+    else:
+      ty._frZ, ty._toZ = staticmethod(frZ), toZ
+
+  def bind(self, ns, v) -> str:
+    name = f'_{len(ns)}'; ns[name] = v
+    return name
+
+  def frZExpr(self, ns, ty, z: str) -> str:
+    """Expression decoding z: a direct call if ty is flat, else a yield."""
+    if isLeaf(ty): return f'{self.bind(ns, ty.frZ)}({z})'
+    if self.isFlat(ty): return f'{self.bind(ns, self.codecs[ty][0])}({z})'
+    return f'(yield {self.bind(ns, ty)}, {z})'
+
+  def toZExpr(self, ns, ty, v: str) -> str:
+    """Expression encoding v: a direct call if ty is flat, else a yield."""
+    if isLeaf(ty): return f'{v}.toZ()'
+    if self.isFlat(ty): return f'{self.bind(ns, self.codecs[ty][1])}({v})'
+    return f'(yield {v})'
+
+  def arrSrc(self, ns, ty, flat) -> str:
+    frZ, toZ = self.frZExpr(ns, ty._ty, 'z'), self.toZExpr(ns, ty._ty, 'v')
+    if flat: return (
+      f'def frZ(raw): return ty([{frZ} for z in raw.arr])\n'
+      f'def toZ(self): return ZoaRaw(None, [{toZ} for v in self])\n')
+    return (
+      f'def frZ(raw):\n'
+      f'  out = []\n'
+      f'  for z in raw.arr: out.append({frZ})\n'
+      f'  return ty(out)\n'
+      f'def toZ(self):\n'
+      f'  out = []\n'
+      f'  for v in self: out.append({toZ})\n'
+      f'  return ZoaRaw(None, out)\n')
+
+  def mapSrc(self, ns, ty, flat) -> str:
+    kfrZ = self.frZExpr(ns, ty._kty, 'arr[i]')
+    vfrZ = self.frZExpr(ns, ty._vty, 'arr[i + 1]')
+    ktoZ, vtoZ = self.toZExpr(ns, ty._kty, 'k'), self.toZExpr(ns, ty._vty, 'v')
+    return (
+      f'def frZ(raw):\n'
+      f'  arr, out = raw.arr, ty()\n'
+      f'  if len(arr) % 2 != 0: raise ValueError(f"length not even: {{raw}}")\n'
+      f'  for i in range(0, len(arr), 2):\n'
+      f'    key = {kfrZ}\n'
+      f'    out[key] = {vfrZ}\n'
+      f'  return out\n'
+      f'def toZ(self):\n'
+      f'  out = []\n'
+      f'  for k, v in self.items(): out.append({ktoZ}); out.append({vtoZ})\n'
+      f'  return ZoaRaw(None, out)\n')
+
+  def structSrc(self, ns, ty, flat) -> str:
+    # Fast path: all positional fields (and no zid fields) are set. Anything
+    # else uses the (generic) StructBase implementation.
+    pos = [attr for attr, _ty, _frZ in ty._posFields]
+    kws = [attr for attr, zid, _leaf in ty._zFields if zid is not None]
+    tys = [f.ty for f in ty._fields.values()]
+    posZ = self.bind(ns, Int(len(pos)).toZ().data)
+    args = ', '.join(self.frZExpr(ns, t, f'arr[{i + 1}]')
+                     for i, t in enumerate(tys[:len(pos)]))
+    zs = ', '.join(self.toZExpr(ns, t, f'self.{a}') for a, t in zip(pos, tys))
+    isSet = ' and '.join([f'self.{a} is not None' for a in pos]
+                         + [f'self.{a} is None' for a in kws]) or 'True'
+    ns['baseFrZ'] = StructBase._frZ.__func__; ns['baseToZ'] = StructBase._toZ
+    if flat: baseFrZ, baseToZ = 'runFrZGen(baseFrZ(ty, z))', 'runToZGen(baseToZ(self))'
+    else:    baseFrZ, baseToZ = '(yield from baseFrZ(ty, z))', '(yield from baseToZ(self))'
+    return (
+      f'def frZ(z):\n'
+      f'  arr = z.arr\n'
+      f'  if len(arr) == {len(pos) + 1} and arr[0].data == {posZ}:\n'
+      f'    return ty({args})\n'
+      f'  return {baseFrZ}\n'
+      f'def toZ(self):\n'
+      f'  if {isSet}:\n'
+      f'    return ZoaRaw(None, [ZoaRaw({posZ}, None), {zs}])\n'
+      f'  return {baseToZ}\n')
+
+  def enumSrc(self, ns, ty, flat) -> str:
+    names = ty._attrs
+    lines = ['def frZ(z):', '  arr = z.arr', '  variant = IntFrZ(arr[0])']
+    for i, (n, (_, var)) in enumerate(zip(names, ty._variants)):
+      lines.append(f'  if variant == {i}: return ty({n}={self.frZExpr(ns, var.ty, "arr[1]")})')
+    lines.append('  raise IndexError(variant)')
+    # the variant tracked by EnumBase, else EnumBase finds it (or raises)
+    lines.extend(['def toZ(self):', '  var = self._var'])
+    for i, (n, (_, var)) in enumerate(zip(names, ty._variants)):
+      zi = self.bind(ns, Int(i).toZ().data)
+      lines.append(f'  if var == {i} and self.{n} is not None:')
+      lines.append(f'    return ZoaRaw(None, [ZoaRaw({zi}, None), '
+                   f'{self.toZExpr(ns, var.ty, "self." + n)}])')
+    base = 'runToZGen(baseToZ(self))' if flat else '(yield from baseToZ(self))'
+    ns['baseToZ'] = EnumBase._toZ
+    lines.append(f'  return {base}')
+    return '\n'.join(lines) + '\n'
+
+class TyEnv:
+  """The type environment.
+
+  If slots=True then struct and bitmap types are created with __slots__ by
+  default, which makes their instances smaller (no per-instance __dict__).
+  """
+  def __init__(self, slots=False):
+    self.slots = slots
     self.tys = {
       b'Str': Str,
       b'Data': Data,
@@ -519,6 +1358,9 @@ class TyEnv:
       b'MapDataDyn': MapDataDyn,
       b'MapStrStr': MapStrStr,
     }
+    self.builtins = set(self.tys)
+    self.codegen = Codegen()
+    self.referrers = {} # Undefined name -> {types which refer to it: None}
 
   def arr(self, ty: Any) -> ArrBase:
     """Create or get generic array type."""
@@ -527,6 +1369,7 @@ class TyEnv:
     if existing: return existing
     arrTy = type(name, (ArrBase,), {'_ty': ty, 'name': name})
     self.tys[name] = arrTy
+    self._refer(arrTy)
     return arrTy
 
   def map(self, kty: Any, vty: Any) -> MapBase:
@@ -536,6 +1379,7 @@ class TyEnv:
     if existing: return existing
     mapTy = type(name, (MapBase,), {'_kty': kty, '_vty': vty, 'name': name})
     self.tys[name] = mapTy
+    self._refer(mapTy)
     return mapTy
 
   def undefined(self, name):
@@ -546,41 +1390,61 @@ class TyEnv:
     self.tys[name] = ty
     return ty
 
-  def struct(self, mod: bytes, name: bytes, fields: Dict[bytes, StructField]):
+  def struct(self, mod: bytes, name: bytes, fields: Dict[bytes, StructField],
+             slots=None, ty=None):
+    """Create a struct type (a dataclass) or use class ty, see pySource."""
     mn = modname(mod, name)
     undefined = self.tys.get(mn)
     if isinstance(undefined, Undefined): pass
     elif mn in self.tys: raise KeyError(f"Modname {mn} already exists")
-    ty = dataclasses.make_dataclass(
+    names = [n.decode('utf-8') for n in fields]
+    if slots is None: slots = self.slots
+    # fields with a zid are optional, so must come after the positional ones
+    zids = [f.zid is not None for f in fields.values()]
+    if zids != sorted(zids): raise ValueError(
+      f"{mn}: positional fields must come before fields with a zid")
+    if ty is None: ty = dataclasses.make_dataclass(
       name.decode('utf-8'),
-      [(n.decode('utf-8'), f.ty) for (n, f) in fields.items()],
+      [(n, f.ty) if f.zid is None else (n, f.ty, dataclasses.field(default=None))
+       for (n, f) in zip(names, fields.values())],
       bases=(StructBase,),
+      slots=slots,
     )
+    else: dataclassFields(ty, [(n, f.ty, f.zid is not None)
+                               for (n, f) in zip(names, fields.values())])
     ty.name = mn
     ty._fields = fields
+    ty._plan()
     return self._register(mn, ty, undefined)
 
-  def enum(self, mod: bytes, name: bytes, variants: List[Tuple[bytes, Any]]):
+  def enum(self, mod: bytes, name: bytes, variants: List[Tuple[bytes, Any]],
+           ty=None):
+    """Create an enum type (a dataclass) or use class ty, see pySource."""
     mn = modname(mod, name)
     undefined = self.tys.get(mn)
     if isinstance(undefined, Undefined): pass
     elif mn in self.tys: raise KeyError(f"Modname {mn} already exists")
-    ty = dataclasses.make_dataclass(
+    if ty is None: ty = dataclasses.make_dataclass(
       name.decode('utf-8'),
       [
-        (n.decode('utf-8'), ty, dataclasses.field(default=None))
-        for (n, ty) in variants
+        (n.decode('utf-8'), v, dataclasses.field(default=None))
+        for (n, v) in variants
       ],
       bases=(EnumBase,),
     )
+    else: dataclassFields(ty, [(n.decode('utf-8'), v, True) for (n, v) in variants])
     ty.name = mn
     ty._variants = variants
+    ty._attrs = tuple(n.decode('utf-8') for n, _v in variants)
     return self._register(mn, ty, undefined)
 
-  def bitmap(self, mod: bytes, name: bytes, variants: List[Tuple[bytes, BmVar]]):
+  def bitmap(self, mod: bytes, name: bytes, variants: List[Tuple[bytes, BmVar]],
+             slots=None):
     mn = modname(mod, name)
     if mn in self.tys: raise KeyError(f"Modname {mn} already exists")
     methods = {'name': mn, '_variants': variants}
+    if slots is None: slots = self.slots
+    if slots: methods['__slots__'] = ()
     for n, var in variants:
       n = n.decode('utf-8')
       methods['get_' + n] = var._getVariantClosure()
@@ -588,18 +1452,191 @@ class TyEnv:
       methods['is_' + n] = var._isVariantClosure()
       methods['tog_' + n] = var._togVariantClosure()
     ty = type(name.decode('utf-8'), (BitmapBase,), methods)
+    ty.Col = self.bitmapCol(ty)
     self.tys[mn] = ty
     return ty
 
+  def bitmapCol(self, ty: BitmapBase) -> BitmapCol:
+    """Create the column type of bitmap type ty, available as ty.Col."""
+    big = any(var.msk | var.var > 0xFFFFFFFF for _n, var in ty._variants)
+    methods = {'name': ty.__name__ + 'Col', '_ty': ty, '__slots__': (),
+               '_typecode': 'Q' if big else 'I'}
+    for n, var in ty._variants:
+      n = n.decode('utf-8')
+      methods['get_' + n] = var._getColClosure()
+      methods['set_' + n] = var._setColClosure()
+      methods['is_' + n] = var._isColClosure()
+    return type(ty.__name__ + 'Col', (BitmapCol,), methods)
+
+  def compile(self):
+    """Replace the toZ/frZ of the env's types with compiled ones.
+
+    This is optional and should be called after all types are defined, see
+    Codegen. Types which were already compiled are not compiled again.
+    """
+    cg = self.codegen
+    tys = [ty for name, ty in self.tys.items() if name not in self.builtins]
+    cg.owned.update(tys)
+    for ty in tys: cg.compile(ty)
+    for ty in tys: # fields may have become leaves
+      if isinstance(ty, type) and issubclass(ty, StructBase): ty._plan()
+
   def _register(self, name, ty, undefined):
     self.tys[name] = ty
+    self._refer(ty)
     if undefined: self._define(name, ty)
     return ty
 
+  def _refer(self, ty):
+    """Track the Undefined types which ty refers to, see _define."""
+    for c in tyChildren(ty) or ():
+      if isinstance(c, Undefined): self.referrers.setdefault(c.name, {})[ty] = None
+
   def _define(self, name, ty):
-    for v in self.tys.values():
-      if hasattr(v, '_define'):
-        v._define(name, ty)
+    """Replace Undefined name with ty in the types which refer to it."""
+    for v in self.referrers.pop(name, ()):
+      v._define(name, ty)
+
+####################
+# Schema cache
+#
+# pySource(env) generates a python module which recreates env without parsing
+# its schema or creating dataclasses (the classes are written out), and
+# loadSchema caches it precompiled (marshaled) in a file named by the schema's
+# hash.
+
+def _sourceStamp() -> bytes:
+  """The mtime and size of zoa.py, which generates the cached code."""
+  st = os.stat(__file__)
+  return b'%d %d' % (st.st_mtime_ns, st.st_size)
+
+def tyExpr(ty, builtins: set) -> str:
+  """Python expression of ty in a pySource module."""
+  if isinstance(ty, Undefined):    return f'env.tys[{ty.name!r}]'
+  if ty in builtins:               return ty.__name__
+  if issubclass(ty, ArrBase):      return f'env.arr({tyExpr(ty._ty, builtins)})'
+  if issubclass(ty, MapBase):      return (
+    f'env.map({tyExpr(ty._kty, builtins)}, {tyExpr(ty._vty, builtins)})')
+  return f'env.tys[{ty.name!r}]'
+
+def classSource(ty, base: str, attrs: List[str], defaults: List[bool],
+                slots: bool, postInit=False) -> List[str]:
+  """Source of a class like the dataclass TyEnv would create."""
+  params = ', '.join(['self'] + [a + '=None' if d else a
+                                 for a, d in zip(attrs, defaults)])
+  fields = ', '.join(f'self.{a}' for a in attrs)
+  others = ', '.join(f'o.{a}' for a in attrs)
+  reprs = ', '.join(f'{a}={{self.{a}!r}}' for a in attrs)
+  lines = [f'class {ty.__name__}({base}):']
+  if slots: lines.append(f'  __slots__ = {tuple(attrs)!r}')
+  lines.extend([
+    f'  __match_args__ = {tuple(attrs)!r}',
+    f'  __hash__ = None',
+    f'  def __init__({params}):',
+    *[f'    self.{a} = {a}' for a in attrs],
+    *(['    self.__post_init__()'] if postInit else []),
+    f'  def __repr__(self): return f"{{type(self).__qualname__}}({reprs})"',
+    f'  def __eq__(self, o):',
+    f'    if o.__class__ is not self.__class__: return NotImplemented',
+    f'    return ({fields},) == ({others},)',
+  ])
+  return lines
+
+# the __dataclass_params__ of the classes make_dataclass creates
+_DATACLASS_PARAMS = dataclasses.dataclass(type('_', (), {})).__dataclass_params__
+
+def dataclassFields(ty, fields: List[Tuple[str, Any, bool]]):
+  """Set the __dataclass_fields__ of a pySource class from (name, type,
+  hasDefault) so that dataclasses.fields, asdict and replace work on it.
+
+  These are the fields make_dataclass would create. _FIELD is private to
+  dataclasses, but fields() skips any field not marked with it.
+  """
+  out = {}
+  for name, fty, hasDefault in fields:
+    f = dataclasses.field(default=None) if hasDefault else dataclasses.field()
+    f.name, f.type, f._field_type = name, fty, dataclasses._FIELD
+    if hasattr(f, 'kw_only'): f.kw_only = False
+    out[name] = f
+  ty.__dataclass_fields__, ty.__dataclass_params__ = out, _DATACLASS_PARAMS
+
+def pySource(env: 'TyEnv') -> str:
+  """Return the source of a python module which recreates env as `env`."""
+  b = {env.tys[name] for name in env.builtins}
+  lines = ['# Generated by zoa.pySource, do not edit.', 'from zoa import *', '',
+           f'env = TyEnv(slots={env.slots!r})']
+  defined = [ty for name, ty in env.tys.items() if name not in env.builtins
+             and (isinstance(ty, Undefined)
+                  or issubclass(ty, (StructBase, EnumBase, BitmapBase)))]
+  # declare all structs and enums so they can refer to eachother in any order
+  for ty in defined:
+    if isinstance(ty, Undefined) or not issubclass(ty, BitmapBase):
+      lines.append(f'env.undefined({ty.name!r})')
+  for ty in defined:
+    if isinstance(ty, Undefined): continue
+    if issubclass(ty, BitmapBase):
+      variants = ', '.join(f'({n!r}, BmVar({v.var:#x}, {v.msk:#x}))'
+                           for n, v in ty._variants)
+      slots = '__slots__' in ty.__dict__
+      lines.extend(['', f'env.bitmap(b"", {ty.name!r}, [{variants}], slots={slots})'])
+    elif issubclass(ty, StructBase):
+      attrs = [n.decode('utf-8') for n in ty._fields]
+      defaults = [f.zid is not None for f in ty._fields.values()]
+      lines.append('')
+      lines.extend(classSource(ty, 'StructBase', attrs, defaults,
+                               slots='__slots__' in ty.__dict__))
+      fields = ', '.join(f'({n!r}, StructField({tyExpr(f.ty, b)}, {f.zid!r}))'
+                         for n, f in ty._fields.items())
+      lines.append(f'env.struct(b"", {ty.name!r}, odict([{fields}]), '
+                   f'ty={ty.__name__})')
+    else:
+      lines.append('')
+      lines.extend(classSource(ty, 'EnumBase', list(ty._attrs),
+                               [True] * len(ty._attrs), False, postInit=True))
+      variants = ', '.join(f'({n!r}, EnumVar({tyExpr(v.ty, b)}))'
+                           for n, v in ty._variants)
+      lines.append(f'env.enum(b"", {ty.name!r}, [{variants}], ty={ty.__name__})')
+  return '\n'.join(lines) + '\n'
+
+def schemaEnv(schema: bytes, slots=False) -> 'TyEnv':
+  """Parse schema into a new TyEnv."""
+  p = Parser(schema, env=TyEnv(slots=slots)); p.parse()
+  return p.env
+
+def _writeCache(cacheDir, path, data):
+  # a unique temporary (like importlib's) so concurrent writers don't mix
+  tmp = f'{path}.{os.getpid()}.{id(data)}'
+  try:
+    os.makedirs(cacheDir, exist_ok=True)
+    with open(tmp, 'xb') as f: marshal.dump(data, f)
+    os.replace(tmp, path)
+  except OSError: # i.e. read-only
+    try: os.unlink(tmp)
+    except OSError: pass
+
+def loadSchema(schema: bytes, cacheDir=None, slots=False,
+               write=True) -> 'TyEnv':
+  """Return the TyEnv of schema, loading it from cacheDir if possible.
+
+  The cache is the compiled (marshaled) code of pySource in a file named by
+  the hash of the schema, slots and the python version. It also stores
+  zoa.py's mtime and size (like .pyc files) and is stale if they changed. It
+  is (over)written on a miss if write, unless cacheDir can't be written.
+  """
+  if cacheDir is None: return schemaEnv(schema, slots)
+  h = hashlib.sha256(b'%d %s\n' % (slots, sys.implementation.cache_tag.encode()))
+  h.update(schema)
+  path = os.path.join(cacheDir, f'zoa-{h.hexdigest()[:32]}.zoac')
+  stamp = _sourceStamp()
+  try:
+    with open(path, 'rb') as f: fstamp, code = marshal.load(f)
+    if fstamp != stamp: raise ValueError('stale')
+  except (OSError, EOFError, ValueError, TypeError):
+    code = compile(pySource(schemaEnv(schema, slots)), path, 'exec')
+    if write: _writeCache(cacheDir, path, (stamp, code))
+  ns = {'__name__': 'zoa_schema'}
+  exec(code, ns)
+  return ns['env']
 
 SINGLES = {ord(c) for c in ['%', '\\', '$', '|', '(', ')', '[', ']']}
 
@@ -630,6 +1667,18 @@ def coaleseTG(group: TG) -> TG:
     return TG.T_ALPHA
   return group
 
+# The (coalesed) TG of every byte and the regexes tokenizing with it.
+TG_TABLE = tuple(coaleseTG(TG.fromChr(c)) for c in range(256))
+
+def tgClass(group: TG) -> bytes:
+  """Regex character class matching the bytes of group."""
+  return b'[' + b''.join(re.escape(bytes([c]))
+                        for c in range(256) if TG_TABLE[c] is group) + b']'
+
+WHITE_RE = re.compile(tgClass(TG.T_WHITE) + b'*')
+TOKEN_RE = re.compile(b'|'.join([
+  tgClass(TG.T_ALPHA) + b'+', tgClass(TG.T_SINGLE), tgClass(TG.T_SYMBOL) + b'+']))
+
 
 class ParseError(RuntimeError):
   def __init__(self, line, msg): return super().__init__(f'line {line}: {msg}')
@@ -650,26 +1699,21 @@ class BaseParser:
   def error(self, msg): raise ParseError(self.line, msg)
 
   def skipWhitespace(self):
-    while self.i < len(self.buf) and TG.fromChr(self.buf[self.i]) is TG.T_WHITE:
-      if self.buf[self.i] == ord('\n'):
-        self.line += 1
-        self.skippedLines += 1
-      else: self.skippedSpaces += 1
-      self.i += 1
+    starti = self.i
+    self.i = WHITE_RE.match(self.buf, starti).end()
+    if self.i == starti: return
+    lines = self.buf.count(b'\n', starti, self.i)
+    self.line += lines
+    self.skippedLines += lines
+    self.skippedSpaces += self.i - starti - lines
 
   def _token(self) -> bytes:
+    """Return the next run of bytes with the same TG (T_SINGLE is one byte)."""
     self.skipWhitespace()
     if self.i == len(self.buf): return
     starti = self.i
-    group = coaleseTG(TG.fromChr(self.buf[self.i]))
-    self.i += 1
-    if group is TG.T_SINGLE:
-      return self.buf[starti:self.i]
-    while self.i < len(self.buf):
-      if coaleseTG(TG.fromChr(self.buf[self.i])) is not group:
-        return self.buf[starti:self.i]
-      self.i += 1
-    return self.buf[starti: self.i]
+    self.i = TOKEN_RE.match(self.buf, starti).end()
+    return self.buf[starti:self.i]
 
   def token(self):
     while self.i < len(self.buf):
@@ -798,3 +1842,17 @@ class Parser(BaseParser):
       elif token == b'struct':  self.parseStruct()
       elif token == b'enum':    self.parseEnum()
       elif token == b'bitmap':  self.parseBitmap()
+
+argP = argparse.ArgumentParser(description='zoa tools.')
+argP.add_argument('cmd', choices=['index'],
+                  help="index: write the sidecar index (PATH.zidx) of zoab files")
+argP.add_argument('paths', nargs='+', help="zoab files")
+argP.add_argument('--depth', type=int, default=1, choices=[1, 2],
+                  help="Also index the items of each item when 2.")
+
+def main(args):
+  for path in args.paths:
+    print(write_zoab_index(path, args.depth))
+
+if __name__ == '__main__':
+  main(argP.parse_args())